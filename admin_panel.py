@@ -1,21 +1,41 @@
 from aiohttp import web
+import asyncio
+import hmac
 import json
+import sqlite3
+import time
 from datetime import datetime
 
 # Безопасный импорт данных из основного бота
 try:
-    from bot import user_stats, blacklist, waiting_queue, active_chats, user_states, user_profiles, anonymous_names
+    from bot import user_stats, blacklist, waiting_queue, active_chats, user_states, user_profiles, anonymous_names, user_caches, broadcaster
+    from bot import message_timestamps, chat_timers, banned_users, message_maps
+    from bot import bot as telegram_bot
+    from bot import ADMIN_BROADCAST_TOKEN
 except ImportError:
     # Если импорт не удался, создаём пустые структуры
-    user_stats = {}
+    from user_cache import UserCache
+    user_stats = UserCache("user_stats", 0)
     blacklist = {}
     waiting_queue = []
     active_chats = {}
-    user_states = {}
-    user_profiles = {}
-    anonymous_names = {}
+    user_states = UserCache("user_states", 0)
+    user_profiles = UserCache("user_profiles", 0)
+    anonymous_names = UserCache("anonymous_names", 0)
+    user_caches = []
+    broadcaster = None
+    message_timestamps = {}
+    chat_timers = {}
+    banned_users = set()
+    message_maps = {}
+    telegram_bot = None
+    ADMIN_BROADCAST_TOKEN = None
 
 from logger_config import log_system_event, log_admin_action
+from memory_tracking import MemoryProfiler, structure_report
+
+# Профилировщик памяти: tracemalloc включается только по запросу из API
+memory_profiler = MemoryProfiler()
 
 # HTML шаблон для админ-панели
 ADMIN_HTML = """
@@ -115,6 +135,39 @@ ADMIN_HTML = """
             </table>
         </div>
         
+        <div class="section">
+            <h2>📣 Рассылка</h2>
+            <table class="table">
+                <tr>
+                    <th>Статус</th>
+                    <th>Отправлено</th>
+                    <th>Заблокировали бота</th>
+                    <th>Ошибок</th>
+                    <th>Сообщений/с</th>
+                    <th>Курсор</th>
+                </tr>
+                {broadcast_row}
+            </table>
+            <form method="post" action="/admin/broadcast">
+                <input type="password" name="token" placeholder="Токен рассылки" autocomplete="off"><br>
+                <textarea name="text" rows="4" cols="80" placeholder="Текст рассылки"></textarea><br>
+                <select name="gender">
+                    <option value="">Любой пол</option>
+                    <option value="male">Мужской</option>
+                    <option value="female">Женский</option>
+                </select>
+                <select name="age">
+                    <option value="">Любой возраст</option>
+                    <option value="under_18">До 18</option>
+                    <option value="18_plus">18+</option>
+                </select>
+                <button class="refresh-btn" name="action" value="start">▶️ Начать</button>
+                <button class="refresh-btn" name="action" value="pause">⏸ Пауза</button>
+                <button class="refresh-btn" name="action" value="resume">⏯ Продолжить</button>
+                <button class="refresh-btn" name="action" value="cancel">⏹ Отменить</button>
+            </form>
+        </div>
+        
         <button class="refresh-btn" onclick="location.reload()">🔄 Обновить</button>
     </div>
 </body>
@@ -135,15 +188,15 @@ async def admin_handler(request):
     active_chats_rows = ""
     for user_id, partner_id in active_chats.items():
         if user_id < partner_id:  # Показываем только одну сторону пары
-            user_nick = anonymous_names.get(user_id, f"User-{user_id}")
-            partner_nick = anonymous_names.get(partner_id, f"User-{partner_id}")
+            user_nick = anonymous_names.peek(user_id, f"User-{user_id}")
+            partner_nick = anonymous_names.peek(partner_id, f"User-{partner_id}")
             active_chats_rows += f"<tr><td>{user_id}</td><td>{partner_id}</td><td>{user_nick}</td><td>{partner_nick}</td></tr>"
     
     # Формируем строки для очереди
     waiting_queue_rows = ""
     for user_id in waiting_queue:
-        profile = user_profiles.get(user_id, {})
-        nick = anonymous_names.get(user_id, f"User-{user_id}")
+        profile = user_profiles.peek(user_id, {})
+        nick = anonymous_names.peek(user_id, f"User-{user_id}")
         gender = profile.get("gender", "Не указан")
         age = profile.get("age", "Не указан")
         waiting_queue_rows += f"<tr><td>{user_id}</td><td>{nick}</td><td>{gender}</td><td>{age}</td></tr>"
@@ -152,20 +205,28 @@ async def admin_handler(request):
     blacklist_rows = ""
     for blocker_id, blocked_users in blacklist.items():
         for blocked_id, block_until in blocked_users.items():
-            blocker_nick = anonymous_names.get(blocker_id, f"User-{blocker_id}")
-            blocked_nick = anonymous_names.get(blocked_id, f"User-{blocked_id}")
+            blocker_nick = anonymous_names.peek(blocker_id, f"User-{blocker_id}")
+            blocked_nick = anonymous_names.peek(blocked_id, f"User-{blocked_id}")
             blacklist_rows += f"<tr><td>{blocker_nick}</td><td>{blocked_nick}</td><td>{block_until.strftime('%Y-%m-%d %H:%M')}</td></tr>"
     
-    # Формируем топ пользователей
-    top_users = sorted(user_stats.items(), key=lambda x: x[1].get("chats_count", 0), reverse=True)[:10]
+    # Формируем топ пользователей (через resident_items, чтобы просмотр панели не продлевал TTL)
+    top_users = sorted(user_stats.resident_items(), key=lambda x: x[1].get("chats_count", 0), reverse=True)[:10]
     top_users_rows = ""
     for user_id, stats in top_users:
-        nick = anonymous_names.get(user_id, f"User-{user_id}")
+        nick = anonymous_names.peek(user_id, f"User-{user_id}")
         chats = stats.get("chats_count", 0)
         messages = stats.get("messages_sent", 0)
         rating = stats.get("rating", 0)
         top_users_rows += f"<tr><td>{nick}</td><td>{chats}</td><td>{messages}</td><td>{rating}</td></tr>"
     
+    # Формируем строку состояния рассылки
+    broadcast = broadcaster.get_status() if broadcaster else {"status": "unavailable"}
+    broadcast_row = (
+        f"<tr><td>{broadcast['status']}</td><td>{broadcast.get('sent', 0)}</td>"
+        f"<td>{broadcast.get('blocked', 0)}</td><td>{broadcast.get('failed', 0)}</td>"
+        f"<td>{broadcast.get('throughput_per_s', 0)}</td><td>{broadcast.get('cursor', '-')}</td></tr>"
+    )
+    
     # Заполняем шаблон
     html = ADMIN_HTML.format(
         total_users=total_users,
@@ -175,7 +236,8 @@ async def admin_handler(request):
         active_chats_rows=active_chats_rows,
         waiting_queue_rows=waiting_queue_rows,
         blacklist_rows=blacklist_rows,
-        top_users_rows=top_users_rows
+        top_users_rows=top_users_rows,
+        broadcast_row=broadcast_row
     )
     
     return web.Response(text=html, content_type='text/html')
@@ -188,17 +250,158 @@ async def api_stats_handler(request):
         "active_chats": len(active_chats) // 2,
         "waiting_queue": len(waiting_queue),
         "total_blocks": sum(len(blocks) for blocks in blacklist.values()),
-        "user_stats": user_stats,
-        "anonymous_names": anonymous_names
+        "user_stats": dict(user_stats.resident_items()),
+        "anonymous_names": dict(anonymous_names.resident_items()),
+        "user_cache": {cache.name: cache.get_stats() for cache in user_caches}
     }
     return web.Response(text=json.dumps(stats, indent=2, default=str), content_type='application/json')
 
+async def broadcast_action_handler(request):
+    """Управление рассылкой из формы админ-панели"""
+    if broadcaster is None:
+        return web.Response(text="Broadcast is unavailable", status=503)
+    if not ADMIN_BROADCAST_TOKEN:
+        return web.Response(text="Broadcast control is disabled: ADMIN_BROADCAST_TOKEN is not set", status=403)
+    form = await request.post()
+    token = form.get("token") or ""
+    if not hmac.compare_digest(token.encode(), ADMIN_BROADCAST_TOKEN.encode()):
+        log_admin_action(0, "Broadcast action rejected", "invalid token")
+        return web.Response(text="Invalid broadcast token", status=403)
+    action = form.get("action")
+    log_admin_action(0, "Broadcast action", action or "")
+    if action == "start":
+        text = (form.get("text") or "").strip()
+        if not text:
+            return web.Response(text="Broadcast text is empty", status=400)
+        try:
+            broadcaster.start(text, gender=form.get("gender") or None, age=form.get("age") or None)
+        except RuntimeError as e:
+            return web.Response(text=str(e), status=409)
+    elif action == "pause":
+        await broadcaster.pause()
+    elif action == "resume":
+        broadcaster.resume()
+    elif action == "cancel":
+        await broadcaster.cancel()
+    else:
+        return web.Response(text="Unknown action", status=400)
+    raise web.HTTPFound("/admin")
+
+async def api_broadcast_handler(request):
+    """API endpoint с прогрессом и скоростью рассылки"""
+    status = broadcaster.get_status() if broadcaster else {"status": "unavailable"}
+    return web.Response(text=json.dumps(status, indent=2, ensure_ascii=False), content_type='application/json')
+
+def json_response(data, status=200):
+    return web.Response(text=json.dumps(data, indent=2, ensure_ascii=False, default=str),
+                        status=status, content_type='application/json')
+
+async def api_memory_handler(request):
+    """Состояние tracemalloc и размеры структур состояния бота"""
+    log_admin_action(0, "Accessed memory report", "JSON endpoint")
+    structures = structure_report({
+        "waiting_queue": waiting_queue,
+        "active_chats": active_chats,
+        "blacklist": blacklist,
+        "banned_users": banned_users,
+        "chat_timers": chat_timers,
+        "message_maps": message_maps,
+        "user_states": user_states,
+        "user_profiles": user_profiles,
+        "anonymous_names": anonymous_names,
+        "user_stats": user_stats,
+        "message_timestamps": message_timestamps,
+    })
+    structures["pending_timer_tasks"] = {
+        "items": sum(1 for task in chat_timers.values() if not task.done()),
+        "approx_kb": None
+    }
+    return json_response({"tracemalloc": memory_profiler.get_status(), "structures": structures})
+
+async def api_memory_start_handler(request):
+    """Включает tracemalloc; ?frames=N — глубина трассировки"""
+    try:
+        frames = int(request.query.get("frames", "1"))
+        memory_profiler.start(frames)
+    except ValueError as e:
+        return json_response({"error": str(e)}, status=400)
+    log_admin_action(0, "Started tracemalloc", f"frames={frames}")
+    return json_response(memory_profiler.get_status())
+
+async def api_memory_stop_handler(request):
+    """Выключает tracemalloc (снимки сохраняются для диффов)"""
+    memory_profiler.stop()
+    log_admin_action(0, "Stopped tracemalloc")
+    return json_response(memory_profiler.get_status())
+
+async def api_memory_snapshot_handler(request):
+    """Делает именованный снимок: ?name=before"""
+    name = request.query.get("name") or datetime.now().strftime("%H%M%S")
+    try:
+        result = memory_profiler.take_snapshot(name)
+    except RuntimeError as e:
+        return json_response({"error": str(e)}, status=409)
+    log_admin_action(0, "Took memory snapshot", name)
+    return json_response(result)
+
+async def api_memory_diff_handler(request):
+    """Топ-N различий между снимками: ?base=a&target=b&top=20&group=lineno|filename"""
+    try:
+        diff = memory_profiler.diff(
+            request.query.get("base", ""),
+            request.query.get("target", ""),
+            top=int(request.query.get("top", "20")),
+            group_by=request.query.get("group", "lineno")
+        )
+    except (KeyError, ValueError) as e:
+        return json_response({"error": str(e)}, status=400)
+    return json_response(diff)
+
+async def api_user_timeline_handler(request):
+    """Хронология пользователя по индексу логов: ?user_id=123&days=7&limit=1000"""
+    from log_index import query_user, index_day, recent_dirs
+    try:
+        user_id = int(request.query["user_id"])
+        days = int(request.query.get("days", "7"))
+        limit = int(request.query.get("limit", "1000"))
+    except (KeyError, ValueError):
+        return json_response({"error": "user_id is required"}, status=400)
+    log_admin_action(0, "Viewed user timeline", str(user_id))
+
+    def lookup():
+        # Дочитываем свежие строки в папках, куда писали за последние сутки (бот мог не перезапускаться)
+        for day_dir in recent_dirs(time.time() - 24 * 3600):
+            index_day(day_dir)
+        return query_user(user_id, days=days, limit=limit)
+
+    try:
+        timeline = await asyncio.to_thread(lookup)
+    except sqlite3.OperationalError as e:
+        return json_response({"error": f"Log index is busy: {e}"}, status=503)
+    return json_response({"user_id": user_id, "entries": len(timeline), "timeline": timeline})
+
+async def api_http_session_handler(request):
+    """Пул соединений Bot API: загрузка, время подключения, задержки по методам"""
+    session = telegram_bot.session if telegram_bot else None
+    if not hasattr(session, "get_stats"):
+        return json_response({"error": "HTTP session metrics are unavailable"}, status=503)
+    return json_response(session.get_stats())
+
 async def start_admin_server():
     """Запускает админ-сервер"""
     try:
         app = web.Application()
         app.router.add_get('/admin', admin_handler)
         app.router.add_get('/api/stats', api_stats_handler)
+        app.router.add_post('/admin/broadcast', broadcast_action_handler)
+        app.router.add_get('/api/broadcast', api_broadcast_handler)
+        app.router.add_get('/api/memory', api_memory_handler)
+        app.router.add_post('/api/memory/start', api_memory_start_handler)
+        app.router.add_post('/api/memory/stop', api_memory_stop_handler)
+        app.router.add_post('/api/memory/snapshot', api_memory_snapshot_handler)
+        app.router.add_get('/api/memory/diff', api_memory_diff_handler)
+        app.router.add_get('/api/user_timeline', api_user_timeline_handler)
+        app.router.add_get('/api/http_session', api_http_session_handler)
         
         runner = web.AppRunner(app)
         await runner.setup()
@@ -218,5 +421,4 @@ async def start_admin_server():
             log_system_event("Failed to start admin panel", str(e))
 
 if __name__ == "__main__":
-    import asyncio
     asyncio.run(start_admin_server()) 
\ No newline at end of file
@@ -0,0 +1,226 @@
+import asyncio
+import os
+import time
+from collections import defaultdict, deque
+from types import SimpleNamespace
+from typing import Any, Deque, Dict, Optional
+
+from aiohttp import ClientSession, TraceConfig
+from aiohttp.hdrs import USER_AGENT
+from aiohttp.http import SERVER_SOFTWARE
+from aiogram import __version__ as aiogram_version
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.methods import GetUpdates, TelegramMethod
+
+from logger_config import log_error
+
+# Таймауты по методам, секунды: загрузка медиа идёт дольше текста
+METHOD_TIMEOUTS = {
+    "SendMessage": 10,
+    "EditMessageText": 10,
+    "EditMessageCaption": 10,
+    "SendSticker": 15,
+    "SendContact": 10,
+    "SendLocation": 10,
+    "SendVenue": 10,
+    "SendPhoto": 30,
+    "SendVoice": 30,
+    "SendAudio": 60,
+    "SendDocument": 60,
+    "SendVideo": 60,
+    "SendVideoNote": 60,
+    "SendAnimation": 60,
+}
+LATENCY_WINDOW = 1000  # последних замеров на метод
+# Внутренние поля AiohttpSession (aiogram 3.4), без которых пул не настроить
+_AIOGRAM_INTERNALS = ("_connector_init", "_connector_type", "_should_reset_connector", "_session")
+
+
+def _percentile_ms(values, pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return round(ordered[index] * 1000, 2)
+
+
+class TunedAiohttpSession(AiohttpSession):
+    """Сессия Bot API с настроенным пулом соединений и метриками.
+
+    - keep-alive пул на pool_size соединений и кэш DNS на dns_ttl секунд;
+      у коннектора на одно соединение больше — оно зарезервировано под long polling,
+      поэтому обычные запросы ограничены семафором на pool_size;
+    - таймауты по методам из METHOD_TIMEOUTS;
+    - задержки запросов по методам; трассировка соединений и DNS (trace=True)
+      стоит заметной доли CPU на каждый запрос и по умолчанию выключена.
+
+    Настройка пула опирается на внутренние поля AiohttpSession. Если их нет
+    (другая версия aiogram), сессия работает как стандартная и пишет об этом в лог.
+    """
+
+    def __init__(self, pool_size: int = 200, dns_ttl: int = 300, keepalive_timeout: float = 30,
+                 trace: bool = False, **kwargs: Any):
+        super().__init__(**kwargs)
+        self.pool_size = pool_size
+        self.tuned = all(hasattr(self, name) for name in _AIOGRAM_INTERNALS)
+        if self.tuned:
+            self._connector_init.update(
+                limit=pool_size + 1,
+                limit_per_host=pool_size + 1,
+                ttl_dns_cache=dns_ttl,
+                keepalive_timeout=keepalive_timeout,
+            )
+        else:
+            log_error("Bot API session tuning unavailable", f"AiohttpSession has no {_AIOGRAM_INTERNALS}")
+        self._semaphore = asyncio.Semaphore(pool_size)
+        self._in_flight = 0
+        self._peak_in_flight = 0
+        self._queued = 0
+        self._errors = 0
+        self._latencies: Dict[str, Deque[float]] = defaultdict(lambda: deque(maxlen=LATENCY_WINDOW))
+        self._queue_waits: Deque[float] = deque(maxlen=LATENCY_WINDOW)
+        self._connect_times: Deque[float] = deque(maxlen=LATENCY_WINDOW)
+        self._dns_times: Deque[float] = deque(maxlen=LATENCY_WINDOW)
+        self._counters = {"connections_created": 0, "connections_reused": 0,
+                          "dns_cache_hits": 0, "dns_cache_misses": 0}
+        self._trace_config = self._build_trace_config() if trace and self.tuned else None
+
+    # --- Трассировка aiohttp ---
+    def _build_trace_config(self) -> TraceConfig:
+        trace = TraceConfig()
+
+        async def on_connection_create_start(session, ctx: SimpleNamespace, params):
+            ctx.connect_started = time.perf_counter()
+
+        async def on_connection_create_end(session, ctx: SimpleNamespace, params):
+            self._counters["connections_created"] += 1
+            self._connect_times.append(time.perf_counter() - ctx.connect_started)
+
+        async def on_connection_reuseconn(session, ctx: SimpleNamespace, params):
+            self._counters["connections_reused"] += 1
+
+        async def on_dns_resolvehost_start(session, ctx: SimpleNamespace, params):
+            ctx.dns_started = time.perf_counter()
+
+        async def on_dns_resolvehost_end(session, ctx: SimpleNamespace, params):
+            self._dns_times.append(time.perf_counter() - ctx.dns_started)
+
+        async def on_dns_cache_hit(session, ctx: SimpleNamespace, params):
+            self._counters["dns_cache_hits"] += 1
+
+        async def on_dns_cache_miss(session, ctx: SimpleNamespace, params):
+            self._counters["dns_cache_misses"] += 1
+
+        trace.on_connection_create_start.append(on_connection_create_start)
+        trace.on_connection_create_end.append(on_connection_create_end)
+        trace.on_connection_reuseconn.append(on_connection_reuseconn)
+        trace.on_dns_resolvehost_start.append(on_dns_resolvehost_start)
+        trace.on_dns_resolvehost_end.append(on_dns_resolvehost_end)
+        trace.on_dns_cache_hit.append(on_dns_cache_hit)
+        trace.on_dns_cache_miss.append(on_dns_cache_miss)
+        return trace
+
+    async def create_session(self) -> ClientSession:
+        if self._trace_config is None:
+            return await super().create_session()
+        # Как в AiohttpSession, но с trace_configs для метрик соединений
+        if self._should_reset_connector:
+            await self.close()
+
+        if self._session is None or self._session.closed:
+            self._session = ClientSession(
+                connector=self._connector_type(**self._connector_init),
+                headers={
+                    USER_AGENT: f"{SERVER_SOFTWARE} aiogram/{aiogram_version}",
+                },
+                trace_configs=[self._trace_config],
+            )
+            self._should_reset_connector = False
+
+        return self._session
+
+    # --- Запросы ---
+    async def make_request(self, bot, method: TelegramMethod, timeout: Optional[int] = None) -> Any:
+        name = type(method).__name__
+        if timeout is None:
+            timeout = METHOD_TIMEOUTS.get(name, self.timeout)
+        if isinstance(method, GetUpdates):
+            # Long polling висит до timeout — не занимаем им слот
+            return await super().make_request(bot, method, timeout)
+
+        queued_at = time.perf_counter()
+        self._queued += 1
+        async with self._semaphore:
+            self._queued -= 1
+            started = time.perf_counter()
+            self._queue_waits.append(started - queued_at)
+            self._in_flight += 1
+            self._peak_in_flight = max(self._peak_in_flight, self._in_flight)
+            try:
+                return await super().make_request(bot, method, timeout)
+            except Exception:
+                self._errors += 1
+                raise
+            finally:
+                self._in_flight -= 1
+                self._latencies[name].append(time.perf_counter() - started)
+
+    # --- Метрики ---
+    def _connector_stats(self) -> Dict[str, Optional[int]]:
+        """Занятые и простаивающие keep-alive соединения по данным коннектора aiohttp.
+
+        Счётчики — внутренние поля TCPConnector (aiohttp 3.9); если их нет, вместо чисел None.
+        """
+        session = getattr(self, "_session", None)
+        connector = session.connector if session is not None and not session.closed else None
+        if connector is None:
+            return {"limit": self.pool_size + 1, "acquired": 0, "idle": 0}
+        acquired = getattr(connector, "_acquired", None)
+        conns = getattr(connector, "_conns", None)
+        return {
+            "limit": connector.limit,
+            "acquired": len(acquired) if acquired is not None else None,
+            "idle": sum(len(c) for c in conns.values()) if conns is not None else None,
+        }
+
+    def get_stats(self) -> Dict[str, Any]:
+        connections = self._connector_stats()
+        utilization = None
+        if connections["acquired"] is not None and connections["limit"]:
+            utilization = round(connections["acquired"] / connections["limit"], 3)
+        stats = {
+            "tuned": self.tuned,
+            "trace": self._trace_config is not None,
+            "pool_size": self.pool_size,
+            "in_flight": self._in_flight,
+            "peak_in_flight": self._peak_in_flight,
+            "queued": self._queued,
+            "connections": connections,
+            "pool_utilization": utilization,
+            "errors": self._errors,
+            "queue_wait_ms": {"p50": _percentile_ms(self._queue_waits, 50),
+                              "p99": _percentile_ms(self._queue_waits, 99)},
+            "latency_ms": {
+                name: {"count": len(values), "p50": _percentile_ms(values, 50), "p99": _percentile_ms(values, 99)}
+                for name, values in self._latencies.items()
+            },
+        }
+        if self._trace_config is not None:
+            stats.update(self._counters)
+            stats["connect_ms"] = {"p50": _percentile_ms(self._connect_times, 50),
+                                   "p99": _percentile_ms(self._connect_times, 99)}
+            stats["dns_ms"] = {"p50": _percentile_ms(self._dns_times, 50),
+                               "p99": _percentile_ms(self._dns_times, 99)}
+        return stats
+
+
+def create_bot_session(**kwargs: Any) -> TunedAiohttpSession:
+    """Сессия с параметрами из окружения (BOT_API_*)"""
+    return TunedAiohttpSession(
+        pool_size=int(os.getenv("BOT_API_POOL_SIZE", "200")),
+        dns_ttl=int(os.getenv("BOT_API_DNS_TTL", "300")),
+        keepalive_timeout=float(os.getenv("BOT_API_KEEPALIVE", "30")),
+        trace=os.getenv("BOT_API_TRACE", "0") == "1",
+        timeout=float(os.getenv("BOT_API_TIMEOUT", "30")),
+        **kwargs
+    )
@@ -0,0 +1,163 @@
+"""Сравнение сессий Bot API на локальном фейковом сервере Telegram.
+
+Поднимает в отдельном процессе aiohttp-сервер, отвечающий на sendMessage как
+Bot API, и отправляет через него одинаковую нагрузку стандартной AiohttpSession
+и TunedAiohttpSession. --latency-ms — время ответа Bot API (по умолчанию 150 мс,
+как у api.telegram.org из Европы): при нём пул из 100 соединений стандартной
+сессии ограничивает отправку сильнее, чем CPU.
+Первый запрос на каждом новом соединении сервер задерживает на --handshake-ms,
+имитируя TCP+TLS рукопожатие, которое на localhost почти бесплатно.
+Нагрузка прогоняется в двух сценариях:
+- steady — пачки идут подряд без пауз: сравнение пула и лимита одновременных
+  запросов, когда обе сессии держат соединения открытыми;
+- bursty — пачки с паузой --idle-s, как relay-трафик с затишьями: пауза длиннее
+  keep-alive стандартной сессии (15 с) заставляет её переподключаться.
+
+    python bench_api_session.py --messages 5000 --concurrency 400 --phases 3 --idle-s 16
+    python bench_api_session.py --scenario steady --trace
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import time
+from typing import Any, Dict
+
+from aiohttp import web
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+
+from api_session import TunedAiohttpSession
+
+FAKE_TOKEN = "123456789:BENCH-bench-bench-bench-bench-bench"
+
+
+def make_fake_api(latency: float, handshake: float) -> web.Application:
+    seen_transports = set()
+    counter = {"message_id": 0}
+
+    async def handle_method(request: web.Request) -> web.Response:
+        transport = request.transport
+        if transport not in seen_transports:
+            # Новое соединение: платим за «рукопожатие»
+            seen_transports.add(transport)
+            await asyncio.sleep(handshake)
+        data = await request.post()
+        await asyncio.sleep(latency)
+        counter["message_id"] += 1
+        result = {
+            "message_id": counter["message_id"],
+            "date": int(time.time()),
+            "chat": {"id": int(data.get("chat_id", 0)), "type": "private"},
+            "text": data.get("text", ""),
+        }
+        return web.json_response({"ok": True, "result": result})
+
+    app = web.Application()
+    app.router.add_post("/bot{token}/{method}", handle_method)
+    return app
+
+
+def serve_fake_api(port: int, latency: float, handshake: float):
+    web.run_app(make_fake_api(latency, handshake), host="127.0.0.1", port=port, print=None)
+
+
+async def wait_for_port(port: int, timeout: float = 10.0):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.1)
+
+
+async def run_load(session, base_url: str, args, idle_s: float) -> Dict[str, Any]:
+    session.api = TelegramAPIServer.from_base(base_url)
+    bot = Bot(token=FAKE_TOKEN, session=session)
+    errors = 0
+    active_time = 0.0
+
+    async def worker(queue: asyncio.Queue):
+        nonlocal errors
+        while True:
+            try:
+                i = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            try:
+                await bot.send_message(1000 + i % 100, f"message {i}")
+            except Exception:
+                errors += 1
+
+    for phase in range(args.phases):
+        if phase:
+            # Затишье: в паузе время не считаем
+            await asyncio.sleep(idle_s)
+        queue: asyncio.Queue = asyncio.Queue()
+        for i in range(args.messages):
+            queue.put_nowait(i)
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(queue) for _ in range(args.concurrency)))
+        active_time += time.perf_counter() - started
+
+    total = args.messages * args.phases
+    result = {"sends_per_s": round(total / active_time, 1), "errors": errors, "active_s": round(active_time, 2)}
+    if isinstance(session, TunedAiohttpSession):
+        stats = session.get_stats()
+        result.update({key: stats[key] for key in ("peak_in_flight", "queue_wait_ms")})
+        if stats["trace"]:
+            result.update({key: stats[key] for key in ("connections_created", "connections_reused", "connect_ms")})
+    await session.close()
+    return result
+
+
+async def bench(args) -> Dict[str, Any]:
+    # Сервер в своём процессе: его обработка запросов не отнимает event loop у клиента
+    server = multiprocessing.Process(
+        target=serve_fake_api, args=(args.port, args.latency_ms / 1000, args.handshake_ms / 1000), daemon=True
+    )
+    server.start()
+    await wait_for_port(args.port)
+    base_url = f"http://127.0.0.1:{args.port}"
+    scenarios = {"steady": 0.0, "bursty": args.idle_s}
+    if args.scenario != "both":
+        scenarios = {args.scenario: scenarios[args.scenario]}
+    try:
+        report = {}
+        for name, idle_s in scenarios.items():
+            report[name] = {
+                "default": await run_load(AiohttpSession(), base_url, args, idle_s),
+                "tuned": await run_load(
+                    TunedAiohttpSession(pool_size=args.pool_size, trace=args.trace),
+                    base_url, args, idle_s
+                ),
+            }
+        return report
+    finally:
+        server.terminate()
+        server.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark Bot API sessions against a local fake server")
+    parser.add_argument("--messages", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=400)
+    parser.add_argument("--latency-ms", type=float, default=150.0, help="задержка ответа сервера")
+    parser.add_argument("--handshake-ms", type=float, default=150.0, help="цена нового соединения")
+    parser.add_argument("--phases", type=int, default=3, help="сколько пачек отправить")
+    parser.add_argument("--idle-s", type=float, default=16.0, help="пауза между пачками в сценарии bursty")
+    parser.add_argument("--scenario", choices=["both", "steady", "bursty"], default="both")
+    parser.add_argument("--pool-size", type=int, default=200)
+    parser.add_argument("--trace", action="store_true", help="включить трассировку соединений в настроенной сессии")
+    parser.add_argument("--port", type=int, default=8099)
+    args = parser.parse_args()
+    print(json.dumps(asyncio.run(bench(args)), indent=2, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+"""Сравнение маршрутизации сообщений: словарь MENU_ROUTES против цепочки фильтров F.text.
+
+Оба диспетчера получают одни и те же синтетические апдейты с преобладанием
+пересылки (по умолчанию 90% обычных сообщений в чате, 10% кнопок меню)
+и работают с заглушкой вместо Telegram API из replay.py.
+
+    python bench_router.py --updates 20000 --relay-share 0.9
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+from datetime import datetime
+from typing import Any, Dict, List
+
+from aiogram import Dispatcher, F
+from aiogram.filters import Command
+from aiogram.types import Update
+
+from message_map import MessageIdRing
+from replay import ReplaySession, load_bot_module, percentile
+
+MENU_TEXTS = ["📊 Моя статистика", "ℹ️ Помощь"]  # не меняют состояние чата
+PAIRS = 500
+
+
+def build_filter_chain_dispatcher(bot_module) -> Dispatcher:
+    """Диспетчер в прежнем виде: по хендлеру на кнопку с фильтром F.text"""
+    dp = Dispatcher()
+    dp.message(Command("start"))(bot_module.cmd_start)
+    dp.message(F.text.in_(["👨 Мужской", "👩 Женский"]))(bot_module.handle_gender)
+    dp.message(F.text.in_(["🔞 До 18", "✅ 18+"]))(bot_module.handle_age)
+    dp.message(F.text == "🟢 Найти собеседника")(bot_module.find_partner)
+    dp.message(F.text == "🔚 Завершить чат")(bot_module.end_chat)
+    dp.message(F.text == "ℹ️ Помощь")(bot_module.help_message)
+    dp.message(F.text.in_(["👍 Хорошо", "👎 Плохо", "😐 Нейтрально"]))(bot_module.handle_rating)
+    dp.message(F.text == "📊 Моя статистика")(bot_module.show_stats)
+    dp.message()(bot_module.relay_message)
+    return dp
+
+
+def make_updates(count: int, relay_share: float, seed: int) -> List[Dict[str, Any]]:
+    rng = random.Random(seed)
+    now = int(datetime.now().timestamp())
+    updates = []
+    for i in range(count):
+        user_id = rng.randint(1, PAIRS * 2)
+        text = f"сообщение {i}" if rng.random() < relay_share else rng.choice(MENU_TEXTS)
+        updates.append({
+            "update_id": i + 1,
+            "message": {
+                "message_id": i + 1,
+                "date": now,
+                "chat": {"id": user_id, "type": "private"},
+                "from": {"id": user_id, "is_bot": False, "first_name": "User"},
+                "text": text,
+            },
+        })
+    return updates
+
+
+def setup_chats(bot_module):
+    """Соединяет пользователей 1..2*PAIRS в пары, чтобы сообщения шли в пересылку"""
+    for user_id in range(1, PAIRS * 2 + 1, 2):
+        partner_id = user_id + 1
+        bot_module.user_states[user_id] = bot_module.UserState.CHATTING
+        bot_module.user_states[partner_id] = bot_module.UserState.CHATTING
+        bot_module.active_chats[user_id] = partner_id
+        bot_module.active_chats[partner_id] = user_id
+        bot_module.message_maps[user_id] = bot_module.message_maps[partner_id] = MessageIdRing(
+            user_id, bot_module.MESSAGE_MAP_SIZE
+        )
+    # Анти-спам иначе превратит почти всю пересылку в предупреждения
+    bot_module.SPAM_LIMIT = 10 ** 9
+
+
+async def run(dp: Dispatcher, bot, updates: List[Dict[str, Any]]) -> Dict[str, Any]:
+    parsed = [Update.model_validate(raw, context={"bot": bot}) for raw in updates]
+    latencies = []
+    started = time.perf_counter()
+    for update in parsed:
+        t0 = time.perf_counter()
+        await dp.feed_update(bot, update)
+        latencies.append(time.perf_counter() - t0)
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return {
+        "updates_per_s": round(len(parsed) / elapsed, 1),
+        "p50_us": round(percentile(latencies, 50) * 1e6, 1),
+        "p99_us": round(percentile(latencies, 99) * 1e6, 1),
+    }
+
+
+async def bench(count: int, relay_share: float, seed: int, rounds: int) -> Dict[str, Any]:
+    bot_module = load_bot_module()
+    bot = bot_module.bot
+    bot.session = ReplaySession()
+    setup_chats(bot_module)
+    updates = make_updates(count, relay_share, seed)
+    dispatchers = {
+        "filter_chain": build_filter_chain_dispatcher(bot_module),
+        "menu_routes": bot_module.dp,
+    }
+    results: Dict[str, Any] = {}
+    # Чередуем прогоны, чтобы прогрев и шум делились поровну
+    for _ in range(rounds):
+        for name, dp in dispatchers.items():
+            result = await run(dp, bot, updates)
+            best = results.get(name)
+            if best is None or result["updates_per_s"] > best["updates_per_s"]:
+                results[name] = result
+    results["speedup"] = round(results["menu_routes"]["updates_per_s"] / results["filter_chain"]["updates_per_s"], 2)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark MENU_ROUTES against the F.text filter chain")
+    parser.add_argument("--updates", type=int, default=20000)
+    parser.add_argument("--relay-share", type=float, default=0.9)
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    report = asyncio.run(bench(args.updates, args.relay_share, args.seed, args.rounds))
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -6,17 +6,39 @@ import random
 import string
 from datetime import datetime, timedelta
 from aiohttp import web
-from aiogram import Bot, Dispatcher, types, F
+from aiogram import Bot, Dispatcher, types
 from aiogram.filters import Command
 from aiogram.types import Message, KeyboardButton, ReplyKeyboardMarkup
 from aiogram.utils.keyboard import ReplyKeyboardBuilder
 from dotenv import load_dotenv
 from logger_config import setup_logging, log_user_action, log_system_event, log_error, log_chat_event
+from user_cache import UserCache, SqliteUserStore, sweep_caches
+from broadcast import Broadcaster
+from message_map import MessageIdRing
+from api_session import create_bot_session
 
 # Загрузка токена из .env
 load_dotenv()
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 
+# Ограничения кэша пользователей в памяти
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "100000"))  # записей на структуру
+USER_CACHE_TTL = int(os.getenv("USER_CACHE_TTL", "86400"))  # секунд без активности
+USER_STORE_PATH = os.getenv("USER_STORE_PATH", "data/users.sqlite3")
+CACHE_SWEEP_INTERVAL = 300  # секунд
+
+# Состояние рассылки (курсор и счётчики) для продолжения после перезапуска
+BROADCAST_STATE_PATH = os.getenv("BROADCAST_STATE_PATH", "data/broadcast.json")
+BROADCAST_RATE = int(os.getenv("BROADCAST_RATE", "25"))  # сообщений в секунду
+# Секрет для управления рассылкой из админ-панели; без него управление отключено
+ADMIN_BROADCAST_TOKEN = os.getenv("ADMIN_BROADCAST_TOKEN")
+
+# Фоновая индексация логов по user_id (см. log_index.py)
+LOG_INDEX_INTERVAL = int(os.getenv("LOG_INDEX_INTERVAL", "60"))  # секунд
+
+# Запись входящего трафика для replay.py (выключено, если путь не задан)
+TRAFFIC_CAPTURE_PATH = os.getenv("TRAFFIC_CAPTURE_PATH")
+
 # Инициализация системы логирования
 logger = setup_logging()
 
@@ -44,22 +66,68 @@ class UserState(Enum):
 # --- In-memory хранилище ---
 waiting_queue: List[int] = []  # user_id
 active_chats: Dict[int, int] = {}  # user_id: partner_id
-user_states: Dict[int, UserState] = {}  # user_id: state
 banned_users: Set[int] = set()  # на будущее
 chat_timers: Dict[int, asyncio.Task] = {}  # user_id: timer_task
+# Общий на пару объект соответствия message_id (для ответов и правок)
+message_maps: Dict[int, MessageIdRing] = {}  # user_id: ring
+MESSAGE_MAP_SIZE = 256  # последних сообщений на чат
+
+# Хранилище, куда вытесняются долговременные поля неактивных пользователей
+user_store = SqliteUserStore(USER_STORE_PATH)
+
+def is_user_active(user_id: int) -> bool:
+    """Пользователи в чате или в очереди не вытесняются из кэшей"""
+    return user_id in active_chats or user_states.peek(user_id) == UserState.SEARCHING
+
+# Эфемерное состояние: при вытеснении просто забывается
+user_states: Dict[int, UserState] = UserCache(
+    "user_states", USER_CACHE_SIZE, ttl=USER_CACHE_TTL, pinned=is_user_active
+)  # user_id: state
 
 # --- Анкеты пользователей ---
-user_profiles: Dict[int, Dict[str, str]] = {}  # user_id: {gender, age}
+user_profiles: Dict[int, Dict[str, str]] = UserCache(
+    "user_profiles", USER_CACHE_SIZE, ttl=USER_CACHE_TTL, store=user_store, pinned=is_user_active
+)  # user_id: {gender, age}
 
 # --- Анонимные имена и рейтинг ---
-anonymous_names: Dict[int, str] = {}  # user_id: anonymous_name
+anonymous_names: Dict[int, str] = UserCache(
+    "anonymous_names", USER_CACHE_SIZE, ttl=USER_CACHE_TTL, store=user_store, pinned=is_user_active
+)  # user_id: anonymous_name
 blacklist: Dict[int, Dict[int, datetime]] = {}  # user_id: {blocked_user_id: block_until}
-user_stats: Dict[int, Dict[str, int]] = {}  # user_id: {chats_count, messages_sent, rating}
+user_stats: Dict[int, Dict[str, int]] = UserCache(
+    "user_stats", USER_CACHE_SIZE, ttl=USER_CACHE_TTL, store=user_store, pinned=is_user_active
+)  # user_id: {chats_count, messages_sent, rating}
 
 # --- Анти-спам ---
-message_timestamps: Dict[int, List[datetime]] = {}  # user_id: [timestamps]
 SPAM_LIMIT = 5  # сообщений
 SPAM_WINDOW = 10  # секунд
+message_timestamps: Dict[int, List[datetime]] = UserCache(
+    "message_timestamps", USER_CACHE_SIZE, ttl=SPAM_WINDOW
+)  # user_id: [timestamps]
+
+user_caches = [user_states, user_profiles, anonymous_names, user_stats, message_timestamps]
+
+async def cache_sweeper():
+    """Периодически вытесняет записи пользователей, неактивных дольше TTL"""
+    while True:
+        await asyncio.sleep(CACHE_SWEEP_INTERVAL)
+        try:
+            sweep_caches(user_caches)
+        except Exception as e:
+            log_error("User cache sweep failed", str(e))
+
+async def log_indexer():
+    """Периодически дочитывает логи в индекс и сжимает завершённые дни"""
+    from log_index import run_indexer
+    while True:
+        await asyncio.sleep(LOG_INDEX_INTERVAL)
+        try:
+            # Индексация читает файлы с диска — уводим её из event loop
+            result = await asyncio.to_thread(run_indexer)
+            if result["compressed_files"]:
+                log_system_event("Compressed finished log days", f"{result['compressed_files']} files")
+        except Exception as e:
+            log_error("Log indexing failed", str(e))
 
 def generate_anonymous_name() -> str:
     """Генерирует случайное анонимное имя"""
@@ -74,11 +142,15 @@ def get_user_anonymous_name(user_id: int) -> str:
         anonymous_names[user_id] = generate_anonymous_name()
     return anonymous_names[user_id]
 
+def current_time() -> datetime:
+    """Часы бота для блокировок и анти-спама; replay.py подменяет их временем из записи"""
+    return datetime.now()
+
 def is_user_blocked(user_id: int, partner_id: int) -> bool:
     """Проверяет, заблокирован ли один пользователь другим"""
     if user_id in blacklist and partner_id in blacklist[user_id]:
         block_until = blacklist[user_id][partner_id]
-        if datetime.now() < block_until:
+        if current_time() < block_until:
             return True
         else:
             # Удаляем истекшую блокировку
@@ -89,12 +161,12 @@ def add_to_blacklist(user_id: int, blocked_user_id: int):
     """Добавляет пользователя в чёрный список на 10 дней"""
     if user_id not in blacklist:
         blacklist[user_id] = {}
-    blacklist[user_id][blocked_user_id] = datetime.now() + timedelta(days=10)
+    blacklist[user_id][blocked_user_id] = current_time() + timedelta(days=10)
     log_user_action(user_id, f"Blocked user {blocked_user_id} for 10 days")
 
 def check_spam(user_id: int) -> bool:
     """Проверяет, не спамит ли пользователь"""
-    now = datetime.now()
+    now = current_time()
     if user_id not in message_timestamps:
         message_timestamps[user_id] = []
     
@@ -178,6 +250,9 @@ async def auto_end_chat(user_id: int, partner_id: int):
         # Удаляем таймеры
         chat_timers.pop(user_id, None)
         chat_timers.pop(partner_id, None)
+        # Забываем соответствие сообщений
+        message_maps.pop(user_id, None)
+        message_maps.pop(partner_id, None)
         log_chat_event(user_id, partner_id, "Auto-ended after 30 minutes")
         # Уведомляем обоих
         try:
@@ -190,14 +265,20 @@ async def auto_end_chat(user_id: int, partner_id: int):
             log_error("Failed to notify partner about auto-end", f"Partner {partner_id}, Error: {e}")
 
 # --- Инициализация бота ---
-bot = Bot(token=BOT_TOKEN)
+# Общая сессия Bot API с настроенным пулом соединений (BOT_API_* в окружении)
+bot = Bot(token=BOT_TOKEN, session=create_bot_session())
 dp = Dispatcher()
 
+# --- Рассылка всем пользователям (запускается из админ-панели) ---
+broadcaster = Broadcaster(bot, user_profiles, BROADCAST_STATE_PATH, rate=BROADCAST_RATE)
+
 # --- Заготовки для хендлеров ---
 @dp.message(Command("start"))
 async def cmd_start(message: Message):
     user_id = message.from_user.id
     log_user_action(user_id, "Started bot")
+    # Получатель рассылок, даже если не заполнит анкету
+    broadcaster.remember_user(user_id)
     # Сброс состояния пользователя
     user_states[user_id] = UserState.IDLE
     # Удаляем из очереди, если вдруг был
@@ -209,6 +290,8 @@ async def cmd_start(message: Message):
         partner_id = active_chats.pop(user_id)
         # Удаляем обратную связь
         active_chats.pop(partner_id, None)
+        message_maps.pop(user_id, None)
+        message_maps.pop(partner_id, None)
         log_chat_event(user_id, partner_id, "Chat ended via /start")
         # Уведомляем партнёра, если он есть
         try:
@@ -228,7 +311,6 @@ async def cmd_start(message: Message):
     )
     await message.answer(text, reply_markup=gender_kb())
 
-@dp.message(F.text.in_(["👨 Мужской", "👩 Женский"]))
 async def handle_gender(message: Message):
     user_id = message.from_user.id
     if user_states.get(user_id) != UserState.FILLING_POLL:
@@ -239,7 +321,6 @@ async def handle_gender(message: Message):
     # Запрашиваем возраст
     await message.answer("Выбери свой возраст:", reply_markup=age_kb())
 
-@dp.message(F.text.in_(["🔞 До 18", "✅ 18+"]))
 async def handle_age(message: Message):
     user_id = message.from_user.id
     if user_states.get(user_id) != UserState.FILLING_POLL:
@@ -258,7 +339,6 @@ async def handle_age(message: Message):
     )
     await message.answer(text, reply_markup=main_menu_kb())
 
-@dp.message(F.text == "🟢 Найти собеседника")
 async def find_partner(message: Message):
     user_id = message.from_user.id
     log_user_action(user_id, "Searching for partner")
@@ -307,6 +387,7 @@ async def find_partner(message: Message):
         # Записываем пару
         active_chats[user_id] = partner_id
         active_chats[partner_id] = user_id
+        message_maps[user_id] = message_maps[partner_id] = MessageIdRing(user_id, MESSAGE_MAP_SIZE)
         # Запускаем таймеры автоматического завершения
         chat_timers[user_id] = asyncio.create_task(auto_end_chat(user_id, partner_id))
         chat_timers[partner_id] = asyncio.create_task(auto_end_chat(partner_id, user_id))
@@ -327,7 +408,6 @@ async def find_partner(message: Message):
         log_user_action(user_id, f"Added to waiting queue (total: {len(waiting_queue)})")
         await message.answer("Ожидание собеседника...", reply_markup=main_menu_kb())
 
-@dp.message(F.text == "🔚 Завершить чат")
 async def end_chat(message: Message):
     user_id = message.from_user.id
     log_user_action(user_id, "Manually ended chat")
@@ -346,6 +426,8 @@ async def end_chat(message: Message):
         if partner_id in chat_timers:
             chat_timers[partner_id].cancel()
             chat_timers.pop(partner_id)
+        message_maps.pop(user_id, None)
+        message_maps.pop(partner_id, None)
         log_chat_event(user_id, partner_id, "Manually ended")
         # Предлагаем оценить собеседника
         user_states[user_id] = UserState.RATING
@@ -361,7 +443,6 @@ async def end_chat(message: Message):
         user_states[user_id] = UserState.IDLE
         await message.answer("Чат завершён. Можешь найти нового собеседника!", reply_markup=main_menu_kb())
 
-@dp.message(F.text == "ℹ️ Помощь")
 async def help_message(message: Message):
     text = (
         "🔒 Анонимный чат 1-на-1\n\n"
@@ -373,7 +454,6 @@ async def help_message(message: Message):
     )
     await message.answer(text, reply_markup=main_menu_kb())
 
-@dp.message(F.text.in_(["👍 Хорошо", "👎 Плохо", "😐 Нейтрально"]))
 async def handle_rating(message: Message):
     user_id = message.from_user.id
     if user_states.get(user_id) != UserState.RATING:
@@ -412,7 +492,6 @@ async def handle_rating(message: Message):
     user_states[user_id] = UserState.IDLE
     await message.answer("Спасибо за оценку! Можешь найти нового собеседника.", reply_markup=main_menu_kb())
 
-@dp.message(F.text == "📊 Моя статистика")
 async def show_stats(message: Message):
     user_id = message.from_user.id
     stats = user_stats.get(user_id, {"chats_count": 0, "messages_sent": 0, "rating": 0})
@@ -429,7 +508,6 @@ async def show_stats(message: Message):
     await message.answer(text, reply_markup=main_menu_kb())
 
 # --- Пересылка сообщений между собеседниками ---
-@dp.message()
 async def relay_message(message: Message):
     user_id = message.from_user.id
     
@@ -445,47 +523,61 @@ async def relay_message(message: Message):
         
         # Обновляем статистику сообщений
         update_user_stats(user_id, "messages_sent")
+        # Пересылка в чате важнее рассылки — забираем у неё часть лимита
+        broadcaster.note_priority_send()
+        
+        # Ответ на сообщение — отвечаем на его копию у собеседника
+        message_map = message_maps.get(user_id)
+        reply_kwargs = {}
+        if message.reply_to_message and message_map:
+            reply_to = message_map.lookup(user_id, message.reply_to_message.message_id)
+            if reply_to:
+                reply_kwargs = {"reply_to_message_id": reply_to, "allow_sending_without_reply": True}
         
+        sent = None
         # Текст
         if message.text:
-            await bot.send_message(partner_id, message.text)
+            sent = await bot.send_message(partner_id, message.text, **reply_kwargs)
         # Фото
         elif message.photo:
-            await bot.send_photo(partner_id, message.photo[-1].file_id, caption=message.caption)
+            sent = await bot.send_photo(partner_id, message.photo[-1].file_id, caption=message.caption, **reply_kwargs)
         # Документ
         elif message.document:
-            await bot.send_document(partner_id, message.document.file_id, caption=message.caption)
+            sent = await bot.send_document(partner_id, message.document.file_id, caption=message.caption, **reply_kwargs)
         # Голосовое
         elif message.voice:
-            await bot.send_voice(partner_id, message.voice.file_id)
+            sent = await bot.send_voice(partner_id, message.voice.file_id, **reply_kwargs)
         # Стикер
         elif message.sticker:
-            await bot.send_sticker(partner_id, message.sticker.file_id)
+            sent = await bot.send_sticker(partner_id, message.sticker.file_id, **reply_kwargs)
         # Видео
         elif message.video:
-            await bot.send_video(partner_id, message.video.file_id, caption=message.caption)
+            sent = await bot.send_video(partner_id, message.video.file_id, caption=message.caption, **reply_kwargs)
         # Аудио
         elif message.audio:
-            await bot.send_audio(partner_id, message.audio.file_id, caption=message.caption)
+            sent = await bot.send_audio(partner_id, message.audio.file_id, caption=message.caption, **reply_kwargs)
         # Контакт
         elif message.contact:
-            await bot.send_contact(partner_id, message.contact.phone_number, message.contact.first_name)
+            sent = await bot.send_contact(partner_id, message.contact.phone_number, message.contact.first_name, **reply_kwargs)
         # Геолокация
         elif message.location:
-            await bot.send_location(partner_id, message.location.latitude, message.location.longitude)
+            sent = await bot.send_location(partner_id, message.location.latitude, message.location.longitude, **reply_kwargs)
         # Место (venue)
         elif message.venue:
-            await bot.send_venue(partner_id, message.venue.location.latitude, message.venue.location.longitude, 
-                               message.venue.title, message.venue.address)
+            sent = await bot.send_venue(partner_id, message.venue.location.latitude, message.venue.location.longitude, 
+                                      message.venue.title, message.venue.address, **reply_kwargs)
         # Анимация (GIF)
         elif message.animation:
-            await bot.send_animation(partner_id, message.animation.file_id, caption=message.caption)
+            sent = await bot.send_animation(partner_id, message.animation.file_id, caption=message.caption, **reply_kwargs)
         # Видео-заметка
         elif message.video_note:
-            await bot.send_video_note(partner_id, message.video_note.file_id)
+            sent = await bot.send_video_note(partner_id, message.video_note.file_id, **reply_kwargs)
         # Если тип не поддержан
         else:
             await bot.send_message(user_id, "Этот тип сообщения пока не поддерживается.")
+        # Запоминаем id копии для ответов и правок
+        if sent and message_map:
+            message_map.add(user_id, message.message_id, sent.message_id)
     elif user_states.get(user_id) == UserState.SEARCHING:
         await message.answer("Ожидание собеседника...", reply_markup=main_menu_kb())
     elif user_states.get(user_id) == UserState.FILLING_POLL:
@@ -495,18 +587,89 @@ async def relay_message(message: Message):
     else:
         await message.answer("Нажмите 'Найти собеседника', чтобы начать чат.", reply_markup=main_menu_kb())
 
+# --- Маршрутизация сообщений ---
+# Кнопки меню сопоставляются с хендлерами одним поиском в словаре вместо
+# цепочки фильтров F.text; всё остальное сразу уходит в relay_message
+MENU_ROUTES = {
+    "👨 Мужской": handle_gender,
+    "👩 Женский": handle_gender,
+    "🔞 До 18": handle_age,
+    "✅ 18+": handle_age,
+    "🟢 Найти собеседника": find_partner,
+    "🔚 Завершить чат": end_chat,
+    "ℹ️ Помощь": help_message,
+    "👍 Хорошо": handle_rating,
+    "👎 Плохо": handle_rating,
+    "😐 Нейтрально": handle_rating,
+    "📊 Моя статистика": show_stats,
+}
+
+@dp.message()
+async def route_message(message: Message):
+    handler = MENU_ROUTES.get(message.text, relay_message)
+    await handler(message)
+
+# --- Пересылка правок сообщений ---
+@dp.edited_message()
+async def relay_edit(message: Message):
+    user_id = message.from_user.id
+    if user_states.get(user_id) != UserState.CHATTING:
+        return
+    partner_id = active_chats.get(user_id)
+    message_map = message_maps.get(user_id)
+    if not partner_id or not message_map:
+        return
+    copy_id = message_map.lookup(user_id, message.message_id)
+    if not copy_id:
+        # Сообщение старше кольца или было отправлено до начала чата
+        return
+    try:
+        if message.text:
+            await bot.edit_message_text(message.text, chat_id=partner_id, message_id=copy_id)
+        elif message.caption is not None:
+            await bot.edit_message_caption(chat_id=partner_id, message_id=copy_id, caption=message.caption)
+    except Exception as e:
+        log_error("Failed to relay edit", f"User {user_id} -> {partner_id}, Error: {e}")
+
 async def main():
     log_system_event("Starting bot")
+    # Включаем запись апдейтов, если задан путь
+    recorder = None
+    if TRAFFIC_CAPTURE_PATH:
+        from traffic_capture import TrafficRecorder
+        recorder = TrafficRecorder(TRAFFIC_CAPTURE_PATH)
+        dp.update.outer_middleware(recorder)
     # Запускаем HTTP сервер в фоне
     http_task = asyncio.create_task(start_http_server())
     # Запускаем админ-панель в фоне
     from admin_panel import start_admin_server
     admin_task = asyncio.create_task(start_admin_server())
+    # Периодическая очистка кэшей неактивных пользователей
+    sweeper_task = asyncio.create_task(cache_sweeper())
+    # Индекс логов для поиска по пользователю
+    indexer_task = asyncio.create_task(log_indexer())
+    # Список получателей рассылок: при первом запуске берём всех, кого знают кэши
+    broadcaster.backfill_known_users(user_caches)
+    # Продолжаем рассылку, прерванную перезапуском
+    if broadcaster.state and broadcaster.state["status"] == "running":
+        broadcaster.resume()
     # Запускаем бота
     await dp.start_polling(bot)
     # Останавливаем HTTP сервер при завершении бота
     http_task.cancel()
     admin_task.cancel()
+    sweeper_task.cancel()
+    indexer_task.cancel()
+    await broadcaster.shutdown()
+    if recorder:
+        recorder.close()
+    # Сохраняем долговременные поля всех пользователей из памяти
+    for cache in user_caches:
+        cache.flush()
+    user_store.close()
 
 if __name__ == "__main__":
+    # Админ-панель импортирует `bot` — пусть получит этот же модуль, а не вторую копию
+    import sys
+    sys.modules.setdefault("bot", sys.modules[__name__])
     asyncio.run(main()) 
\ No newline at end of file
@@ -0,0 +1,303 @@
+import asyncio
+import json
+import time
+from collections import deque
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+
+from logger_config import log_system_event, log_error, log_admin_action
+
+BROADCAST_RATE = 25  # сообщений в секунду (лимит Telegram ~30, остаток — запас)
+BROADCAST_BATCH = 500  # сколько user_id читать из хранилища за раз
+MAX_SEND_ATTEMPTS = 3
+PRIORITY_WINDOW = 1.0  # секунд: окно учёта пересылок в чатах
+THROUGHPUT_WINDOW = 10.0  # секунд: окно расчёта скорости рассылки
+BLOCKED_NAMESPACE = "bot_blocked"  # пространство store: пользователи, заблокировавшие бота
+KNOWN_USERS_NAMESPACE = "known_users"  # пространство store: все, кто когда-либо нажимал /start
+
+
+def _trim(times: deque, window: float):
+    """Удаляет из очереди monotonic-меток всё старше window секунд"""
+    cutoff = time.monotonic() - window
+    while times and times[0] < cutoff:
+        times.popleft()
+
+
+class Broadcaster:
+    """Рассылка сообщения всем известным пользователям с соблюдением лимитов Telegram.
+
+    Получатели — все известные пользователи из KNOWN_USERS_NAMESPACE, включая
+    не заполнивших анкету; анкета нужна только для отбора по сегменту.
+    Получатели перебираются по возрастанию user_id, курсор (последний
+    обработанный id) сохраняется на диск после каждой секунды отправки,
+    поэтому прерванная рассылка продолжается с места остановки.
+    Пересылка в живых чатах имеет приоритет: её отправки за последнюю
+    секунду вычитаются из бюджета рассылки.
+    Пауза, отмена и выключение дожидаются конца текущей пачки, поэтому
+    после продолжения уже доставленные сообщения не отправляются повторно.
+    Заблокировавшие бота запоминаются в store и пропускаются следующими рассылками.
+    """
+
+    def __init__(self, bot: Bot, users, state_path: str, rate: int = BROADCAST_RATE):
+        self.bot = bot
+        self.users = users  # UserCache анкет: сегменты; его store хранит список получателей
+        self.state_path = Path(state_path)
+        self.rate = rate
+        self.state: Optional[Dict[str, Any]] = self._load_state()
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = asyncio.Event()
+        self._priority_sends: deque = deque()  # monotonic-метки отправок пересылки
+        self._sent_times: deque = deque()  # monotonic-метки отправок рассылки
+
+    # --- Состояние ---
+    def _load_state(self) -> Optional[Dict[str, Any]]:
+        if not self.state_path.exists():
+            return None
+        try:
+            return json.loads(self.state_path.read_text(encoding="utf-8"))
+        except (OSError, ValueError) as e:
+            log_error("Failed to load broadcast state", str(e))
+            return None
+
+    def _save_state(self):
+        self.state_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.state_path.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps(self.state, ensure_ascii=False, indent=2), encoding="utf-8")
+        tmp_path.replace(self.state_path)
+
+    @property
+    def is_running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    # --- Приоритет живых чатов ---
+    def note_priority_send(self):
+        """Вызывается при каждой пересылке в чате, чтобы рассылка уступала ей лимит"""
+        # Чистим сразу: без рассылки _budget() не вызывается, и очередь росла бы без конца
+        _trim(self._priority_sends, PRIORITY_WINDOW)
+        self._priority_sends.append(time.monotonic())
+
+    def _budget(self) -> int:
+        """Сколько сообщений рассылки можно отправить в ближайшую секунду"""
+        _trim(self._priority_sends, PRIORITY_WINDOW)
+        return max(0, self.rate - len(self._priority_sends))
+
+    # --- Известные пользователи ---
+    def remember_user(self, user_id: int):
+        """Запоминает пользователя как получателя рассылок; вызывается на /start"""
+        store = self.users.store
+        if store is not None and store.get(KNOWN_USERS_NAMESPACE, user_id) is None:
+            store.put(KNOWN_USERS_NAMESPACE, user_id, datetime.now().isoformat(timespec="seconds"))
+        # Раз пишет — бот не заблокирован, снова получает рассылки
+        self.forget_blocked(user_id)
+
+    def backfill_known_users(self, caches) -> int:
+        """Однократно переносит в список получателей пользователей, известных кэшам до его появления"""
+        store = self.users.store
+        if store is None or store.count(KNOWN_USERS_NAMESPACE):
+            return 0
+        seen_at = datetime.now().isoformat(timespec="seconds")
+        added = 0
+        for cache in caches:
+            cursor = 0
+            while True:
+                ids = cache.ids_after(cursor, BROADCAST_BATCH)
+                if not ids:
+                    break
+                store.put_many(KNOWN_USERS_NAMESPACE, [(uid, seen_at) for uid in ids])
+                added += len(ids)
+                cursor = ids[-1]
+        if added:
+            log_system_event("Broadcast recipients backfilled", f"{store.count(KNOWN_USERS_NAMESPACE)} users")
+        return added
+
+    def _recipients_after(self, cursor: int):
+        store = self.users.store
+        if store is None:
+            return self.users.ids_after(cursor, BROADCAST_BATCH)
+        return store.ids_after(KNOWN_USERS_NAMESPACE, cursor, BROADCAST_BATCH)
+
+    # --- Заблокировавшие бота ---
+    def _is_blocked(self, user_id: int) -> bool:
+        store = self.users.store
+        return store is not None and store.get(BLOCKED_NAMESPACE, user_id) is not None
+
+    def _remember_blocked(self, user_ids):
+        store = self.users.store
+        if store is not None and user_ids:
+            blocked_at = datetime.now().isoformat(timespec="seconds")
+            store.put_many(BLOCKED_NAMESPACE, [(uid, blocked_at) for uid in user_ids])
+
+    def forget_blocked(self, user_id: int):
+        """Пользователь снова написал боту — он больше не считается заблокировавшим"""
+        store = self.users.store
+        if store is not None and store.get(BLOCKED_NAMESPACE, user_id) is not None:
+            store.delete(BLOCKED_NAMESPACE, user_id)
+
+    # --- Управление ---
+    def start(self, text: str, gender: Optional[str] = None, age: Optional[str] = None) -> Dict[str, Any]:
+        if self.is_running:
+            raise RuntimeError("Broadcast is already running")
+        self.state = {
+            "id": datetime.now().strftime("%Y%m%d-%H%M%S"),
+            "text": text,
+            "segment": {"gender": gender, "age": age},
+            "status": "running",
+            "cursor": 0,
+            "sent": 0,
+            "blocked": 0,
+            "failed": 0,
+            "skipped": 0,
+            "retry_after_waits": 0,
+            "started_at": datetime.now().isoformat(timespec="seconds"),
+            "finished_at": None,
+        }
+        self._save_state()
+        log_admin_action(0, "Broadcast started", f"{self.state['id']} segment={self.state['segment']}")
+        self._stopping.clear()
+        self._task = asyncio.create_task(self._run())
+        return self.get_status()
+
+    def resume(self) -> bool:
+        """Продолжает прерванную или приостановленную рассылку с сохранённого курсора"""
+        if self.is_running or not self.state or self.state["status"] not in ("running", "paused"):
+            return False
+        self.state["status"] = "running"
+        self._save_state()
+        log_system_event("Broadcast resumed", f"{self.state['id']} from user {self.state['cursor']}")
+        self._stopping.clear()
+        self._task = asyncio.create_task(self._run())
+        return True
+
+    async def _wait_batch(self):
+        """Просит задачу остановиться после текущей пачки и ждёт её"""
+        if self.is_running:
+            self._stopping.set()
+            await self._task
+
+    async def shutdown(self):
+        """Останавливает задачу при выключении бота, оставляя статус для автопродолжения"""
+        await self._wait_batch()
+
+    async def pause(self):
+        await self._stop("paused")
+
+    async def cancel(self):
+        await self._stop("cancelled")
+
+    async def _stop(self, status: str):
+        if not self.state or self.state["status"] not in ("running", "paused"):
+            return
+        await self._wait_batch()
+        if self.state["status"] == "finished":
+            # Пачка оказалась последней — рассылка успела завершиться
+            return
+        self.state["status"] = status
+        self._save_state()
+        log_admin_action(0, f"Broadcast {status}", self.state["id"])
+
+    # --- Рассылка ---
+    def _matches_segment(self, user_id: int) -> bool:
+        segment = self.state["segment"]
+        if not segment.get("gender") and not segment.get("age"):
+            return True
+        profile = self.users.lookup(user_id) or {}
+        return all(
+            not segment.get(field) or profile.get(field) == segment[field]
+            for field in ("gender", "age")
+        )
+
+    async def _send_one(self, user_id: int) -> bool:
+        """Отправляет сообщение рассылки. Возвращает True, если пользователь заблокировал бота"""
+        for attempt in range(MAX_SEND_ATTEMPTS):
+            try:
+                await self.bot.send_message(user_id, self.state["text"])
+                self.state["sent"] += 1
+                _trim(self._sent_times, THROUGHPUT_WINDOW)
+                self._sent_times.append(time.monotonic())
+                return False
+            except TelegramRetryAfter as e:
+                # Telegram просит подождать: ждём и повторяем этому же пользователю
+                self.state["retry_after_waits"] += 1
+                log_system_event("Broadcast got RetryAfter", f"Waiting {e.retry_after}s")
+                await asyncio.sleep(e.retry_after)
+            except TelegramForbiddenError:
+                # Пользователь заблокировал бота
+                self.state["blocked"] += 1
+                return True
+            except TelegramBadRequest as e:
+                self.state["failed"] += 1
+                log_error("Broadcast send failed", f"User {user_id}, Error: {e}")
+                return False
+            except Exception as e:
+                if attempt == MAX_SEND_ATTEMPTS - 1:
+                    self.state["failed"] += 1
+                    log_error("Broadcast send failed", f"User {user_id}, Error: {e}")
+                    return False
+                await asyncio.sleep(1)
+        self.state["failed"] += 1
+        return False
+
+    async def _run(self):
+        try:
+            pending = []
+            while not self._stopping.is_set():
+                if not pending:
+                    pending = self._recipients_after(self.state["cursor"])
+                    if not pending:
+                        break
+                tick_started = time.monotonic()
+                budget = self._budget()
+                if budget:
+                    # Набираем получателей из сегмента; остальные не тратят лимит
+                    recipients = []
+                    consumed = 0
+                    for uid in pending:
+                        consumed += 1
+                        if self._matches_segment(uid) and not self._is_blocked(uid):
+                            recipients.append(uid)
+                            if len(recipients) >= budget:
+                                break
+                    chunk, pending = pending[:consumed], pending[consumed:]
+                    self.state["skipped"] += consumed - len(recipients)
+                    blocked = await asyncio.gather(*(self._send_one(uid) for uid in recipients))
+                    self._remember_blocked([uid for uid, was_blocked in zip(recipients, blocked) if was_blocked])
+                    self.state["cursor"] = chunk[-1]
+                    self._save_state()
+                # Отправляем не чаще одной пачки в секунду; остановка прерывает ожидание
+                try:
+                    await asyncio.wait_for(
+                        self._stopping.wait(), max(0.0, 1 - (time.monotonic() - tick_started))
+                    )
+                except asyncio.TimeoutError:
+                    pass
+            else:
+                # Остановлены между пачками: курсор уже сохранён, статус выставит вызвавший
+                return
+            self.state["status"] = "finished"
+            self.state["finished_at"] = datetime.now().isoformat(timespec="seconds")
+            self._save_state()
+            log_system_event(
+                "Broadcast finished",
+                f"{self.state['id']}: sent={self.state['sent']} blocked={self.state['blocked']} failed={self.state['failed']}"
+            )
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.state["status"] = "paused"
+            self._save_state()
+            log_error("Broadcast crashed, paused", str(e))
+
+    # --- Прогресс ---
+    def get_status(self) -> Dict[str, Any]:
+        if not self.state:
+            return {"status": "idle"}
+        _trim(self._sent_times, THROUGHPUT_WINDOW)
+        status = dict(self.state)
+        status["throughput_per_s"] = round(len(self._sent_times) / THROUGHPUT_WINDOW, 1)
+        status["rate_limit_per_s"] = self.rate
+        status["chat_priority_sends_per_s"] = self.rate - self._budget()
+        return status
@@ -0,0 +1,406 @@
+"""Индекс user_id -> смещения строк в дневных логах для быстрых ответов поддержке.
+
+В каждой папке logs/YYYY-MM-DD/ создаётся index.sqlite3 с позициями строк,
+в которых упоминается пользователь. Индексатор дочитывает логи с места
+прошлой остановки, поэтому его можно запускать периодически.
+
+Папка названа по дню запуска бота, а логгер не переключается в полночь,
+поэтому в одной папке бывают строки за несколько дней. Дата берётся из
+самой строки, а день считается завершённым, когда его логи не менялись
+FINISHED_AFTER секунд. Логи завершённых дней сжимаются поблочно (zlib,
+блоки по BLOCK_SIZE байт): таблица блоков в индексе позволяет читать
+любую строку без распаковки всего файла.
+
+Логи бывают по несколько гигабайт, поэтому индексатор читает их порциями
+по INDEX_CHUNK_LINES строк и фиксирует позицию после каждой. Фоновый
+индексатор бота, админ-панель и CLI работают под общей блокировкой
+(файл logs/.index.lock): между порциями она отпускается, и запрос
+поддержки ждёт не дольше одной порции.
+
+    python log_index.py build               # проиндексировать все дни
+    python log_index.py compress            # сжать завершённые дни
+    python log_index.py query 123456 --days 3
+"""
+import argparse
+import bisect
+import json
+import logging
+import re
+import sqlite3
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Set, Tuple
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+LOGS_DIR = Path("logs")
+INDEX_NAME = "index.sqlite3"
+COMPRESSED_SUFFIX = ".zblk"
+BLOCK_SIZE = 256 * 1024  # несжатых байт в блоке
+TIMELINE_FILES = ("user_actions.log", "all.log")
+FINISHED_AFTER = 24 * 3600  # секунд без записи, после которых логи папки можно сжимать
+INDEX_CHUNK_LINES = 100_000  # строк лога за одну транзакцию индекса
+LOCK_NAME = ".index.lock"
+
+# Упоминания пользователя в сообщениях logger_config: "User 1", "Partner 2", "<-> 3", "user 4"
+USER_ID_RE = re.compile(rb"(?:\b(?:[Uu]ser|[Pp]artner)|<->)\s+(\d+)")
+# Новая запись начинается с даты; строки без неё — продолжение (traceback)
+RECORD_START_RE = re.compile(rb"^\d{4}-\d{2}-\d{2} ")
+DAY_DIR_RE = re.compile(r"^\d{4}-\d{2}-\d{2}$")
+
+
+# --- Общая блокировка индекса ---
+_thread_lock = threading.RLock()
+_lock_depth = 0
+
+
+@contextmanager
+def index_lock(logs_dir: Path = LOGS_DIR) -> Iterator[None]:
+    """Блокировка индексов и логов для потоков этого процесса и других процессов (CLI).
+
+    Реентерабельна в пределах потока: файл блокируется только на внешнем уровне.
+    """
+    global _lock_depth
+    with _thread_lock:
+        if _lock_depth:
+            _lock_depth += 1
+            try:
+                yield
+            finally:
+                _lock_depth -= 1
+            return
+        logs_dir.mkdir(parents=True, exist_ok=True)
+        with open(logs_dir / LOCK_NAME, "a+b") as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            else:
+                lock_file.seek(0)
+                while True:
+                    try:
+                        msvcrt.locking(lock_file.fileno(), msvcrt.LK_NBLCK, 1)
+                        break
+                    except OSError:
+                        time.sleep(0.1)
+            _lock_depth = 1
+            try:
+                yield
+            finally:
+                _lock_depth = 0
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+                else:
+                    lock_file.seek(0)
+                    msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def _connect(day_dir: Path) -> sqlite3.Connection:
+    with index_lock(day_dir.parent):
+        return _open_index(day_dir)
+
+
+def _open_index(day_dir: Path) -> sqlite3.Connection:
+    conn = sqlite3.connect(day_dir / INDEX_NAME, timeout=30)
+    conn.executescript(
+        "CREATE TABLE IF NOT EXISTS files (file_id INTEGER PRIMARY KEY, name TEXT UNIQUE NOT NULL, "
+        "indexed_to INTEGER NOT NULL DEFAULT 0, compressed INTEGER NOT NULL DEFAULT 0);"
+        "CREATE TABLE IF NOT EXISTS offsets (user_id INTEGER NOT NULL, file_id INTEGER NOT NULL, "
+        "offset INTEGER NOT NULL, day TEXT);"
+        "CREATE INDEX IF NOT EXISTS offsets_user ON offsets (user_id, file_id, offset);"
+        "CREATE TABLE IF NOT EXISTS blocks (file_id INTEGER NOT NULL, raw_offset INTEGER NOT NULL, "
+        "comp_offset INTEGER NOT NULL, comp_size INTEGER NOT NULL, PRIMARY KEY (file_id, raw_offset));"
+    )
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(offsets)")}
+    if "day" not in columns:
+        # Индекс старого формата: у уже записанных смещений дата строки неизвестна (NULL)
+        conn.execute("ALTER TABLE offsets ADD COLUMN day TEXT")
+        conn.commit()
+    return conn
+
+
+def _file_row(conn: sqlite3.Connection, name: str) -> Tuple[int, int, int]:
+    conn.execute("INSERT OR IGNORE INTO files (name) VALUES (?)", (name,))
+    row = conn.execute(
+        "SELECT file_id, indexed_to, compressed FROM files WHERE name = ?", (name,)
+    ).fetchone()
+    conn.commit()
+    return row
+
+
+def day_dirs(logs_dir: Path = LOGS_DIR) -> List[Path]:
+    if not logs_dir.exists():
+        return []
+    return sorted(p for p in logs_dir.iterdir() if p.is_dir() and DAY_DIR_RE.match(p.name))
+
+
+def last_modified(day_dir: Path) -> float:
+    """Время последней записи в логи папки (mtime самого свежего файла)"""
+    mtimes = [p.stat().st_mtime for p in day_dir.iterdir() if p.name != INDEX_NAME]
+    return max(mtimes, default=0.0)
+
+
+def recent_dirs(since: float, logs_dir: Path = LOGS_DIR) -> List[Path]:
+    """Папки, в которые писали после since (unix time) — по mtime, а не по имени"""
+    return [day_dir for day_dir in day_dirs(logs_dir) if last_modified(day_dir) >= since]
+
+
+def active_log_dirs() -> Set[Path]:
+    """Папки, в которые сейчас пишут файловые хендлеры логирования"""
+    dirs = set()
+    for name in [None, "user_actions"]:
+        for handler in logging.getLogger(name).handlers:
+            filename = getattr(handler, "baseFilename", None)
+            if filename:
+                dirs.add(Path(filename).parent.resolve())
+    return dirs
+
+
+# --- Индексация ---
+def _read_chunk(path: Path, file_id: int, start: int) -> Tuple[List[Tuple[int, int, int, str]], int, bool]:
+    """Читает до INDEX_CHUNK_LINES строк с позиции start: (смещения, новая позиция, дочитан ли файл)"""
+    rows = []
+    offset = start
+    with open(path, "rb") as f:
+        f.seek(start)
+        for _ in range(INDEX_CHUNK_LINES):
+            line = f.readline()
+            if not line.endswith(b"\n"):
+                # Конец файла или строка ещё дописывается — вернёмся к ней в следующий раз
+                return rows, offset, True
+            if RECORD_START_RE.match(line):
+                day = line[:10].decode("ascii")
+                for user_id in set(USER_ID_RE.findall(line)):
+                    rows.append((int(user_id), file_id, offset, day))
+            offset += len(line)
+    return rows, offset, False
+
+
+def index_file(conn: sqlite3.Connection, day_dir: Path, name: str) -> int:
+    """Дочитывает лог с последней позиции и добавляет смещения. Возвращает число новых записей"""
+    path = day_dir / name
+    added = 0
+    done = False
+    while not done:
+        # Блокировка на одну порцию: позиция фиксируется, и другие ждут не дольше порции
+        with index_lock(day_dir.parent):
+            file_id, indexed_to, compressed = _file_row(conn, name)
+            if compressed or not path.exists() or path.stat().st_size <= indexed_to:
+                break
+            rows, offset, done = _read_chunk(path, file_id, indexed_to)
+            conn.executemany("INSERT INTO offsets (user_id, file_id, offset, day) VALUES (?, ?, ?, ?)", rows)
+            conn.execute("UPDATE files SET indexed_to = ? WHERE file_id = ?", (offset, file_id))
+            conn.commit()
+            added += len(rows)
+    return added
+
+
+def index_day(day_dir: Path) -> int:
+    conn = _connect(day_dir)
+    try:
+        return sum(index_file(conn, day_dir, path.name) for path in sorted(day_dir.glob("*.log")))
+    finally:
+        conn.close()
+
+
+# --- Сжатие завершённых дней ---
+def compress_file(conn: sqlite3.Connection, day_dir: Path, name: str) -> bool:
+    """Сжимает лог независимыми zlib-блоками по границам строк и удаляет оригинал.
+
+    Сжатие идёт во временный файл без блокировки; под блокировкой только
+    подмена, чтобы читатель не открыл лог в момент удаления.
+    """
+    with index_lock(day_dir.parent):
+        file_id, indexed_to, compressed = _file_row(conn, name)
+    path = day_dir / name
+    if compressed or not path.exists():
+        return False
+    blocks = []
+    raw_offset = comp_offset = 0
+    tmp_path = day_dir / (name + COMPRESSED_SUFFIX + ".tmp")
+    with open(path, "rb") as src, open(tmp_path, "wb") as dst:
+        while True:
+            chunk = src.read(BLOCK_SIZE)
+            if not chunk:
+                break
+            # Дочитываем до конца строки, чтобы строка не рвалась между блоками
+            if not chunk.endswith(b"\n"):
+                chunk += src.readline()
+            data = zlib.compress(chunk, 6)
+            dst.write(data)
+            blocks.append((file_id, raw_offset, comp_offset, len(data)))
+            raw_offset += len(chunk)
+            comp_offset += len(data)
+    with index_lock(day_dir.parent):
+        if path.stat().st_size != raw_offset:
+            # Лог дописали во время сжатия — день не завершён, попробуем в следующий раз
+            tmp_path.unlink()
+            return False
+        tmp_path.replace(day_dir / (name + COMPRESSED_SUFFIX))
+        conn.execute("DELETE FROM blocks WHERE file_id = ?", (file_id,))
+        conn.executemany(
+            "INSERT INTO blocks (file_id, raw_offset, comp_offset, comp_size) VALUES (?, ?, ?, ?)", blocks
+        )
+        conn.execute("UPDATE files SET compressed = 1 WHERE file_id = ?", (file_id,))
+        conn.commit()
+        path.unlink()
+    return True
+
+
+def is_finished(day_dir: Path, active: Set[Path]) -> bool:
+    """Папку больше не пишут: логи давно не менялись и не открыты хендлерами этого процесса.
+
+    Проверка по mtime нужна для CLI и других процессов: у них нет хендлеров,
+    а бот может писать в папку, названную несколько дней назад.
+    """
+    if day_dir.resolve() in active:
+        return False
+    return time.time() - last_modified(day_dir) >= FINISHED_AFTER
+
+
+def compress_finished_days(logs_dir: Path = LOGS_DIR) -> List[str]:
+    """Индексирует до конца и сжимает дни, которые уже не пишутся"""
+    active = active_log_dirs()
+    done = []
+    for day_dir in day_dirs(logs_dir):
+        if not is_finished(day_dir, active):
+            continue
+        conn = _connect(day_dir)
+        try:
+            for path in sorted(day_dir.glob("*.log")):
+                index_file(conn, day_dir, path.name)
+                if compress_file(conn, day_dir, path.name):
+                    done.append(str(path))
+        finally:
+            conn.close()
+    return done
+
+
+def run_indexer(logs_dir: Path = LOGS_DIR) -> Dict[str, int]:
+    """Один проход фонового индексатора: дочитать все дни и сжать завершённые"""
+    indexed = sum(index_day(day_dir) for day_dir in day_dirs(logs_dir))
+    compressed = len(compress_finished_days(logs_dir))
+    return {"indexed": indexed, "compressed_files": compressed}
+
+
+# --- Чтение ---
+class _LogReader:
+    """Читает строку по смещению из обычного или поблочно сжатого файла"""
+
+    def __init__(self, conn: sqlite3.Connection, day_dir: Path, file_id: int, name: str, compressed: bool):
+        self.compressed = compressed
+        if compressed:
+            self.blocks = conn.execute(
+                "SELECT raw_offset, comp_offset, comp_size FROM blocks WHERE file_id = ? ORDER BY raw_offset",
+                (file_id,)
+            ).fetchall()
+            self.block_starts = [b[0] for b in self.blocks]
+            self.file = open(day_dir / (name + COMPRESSED_SUFFIX), "rb")
+            self._cached: Tuple[int, bytes] = (-1, b"")
+        else:
+            self.file = open(day_dir / name, "rb")
+
+    def read_line(self, offset: int) -> str:
+        if not self.compressed:
+            self.file.seek(offset)
+            line = self.file.readline()
+        else:
+            i = bisect.bisect_right(self.block_starts, offset) - 1
+            if self._cached[0] != i:
+                raw_offset, comp_offset, comp_size = self.blocks[i]
+                self.file.seek(comp_offset)
+                self._cached = (i, zlib.decompress(self.file.read(comp_size)))
+            data = self._cached[1]
+            start = offset - self.blocks[i][0]
+            end = data.find(b"\n", start)
+            line = data[start:end + 1 if end != -1 else len(data)]
+        return line.decode("utf-8", errors="replace").rstrip("\n")
+
+    def close(self):
+        self.file.close()
+
+
+def query_user(user_id: int, days: int = 7, files: Iterable[str] = TIMELINE_FILES,
+               limit: int = 1000, logs_dir: Path = LOGS_DIR) -> List[Dict[str, str]]:
+    """Хронология пользователя за последние days дней по индексам (без полного чтения логов)"""
+    since_dt = (datetime.now() - timedelta(days=days - 1)).replace(hour=0, minute=0, second=0, microsecond=0)
+    since = since_dt.strftime("%Y-%m-%d")
+    files = list(files)
+    timeline = []
+    # Старая папка может содержать свежие строки, если бот не перезапускался
+    for day_dir in recent_dirs(since_dt.timestamp(), logs_dir):
+        if not (day_dir / INDEX_NAME).exists():
+            continue
+        # Под блокировкой сжатие не удалит лог, который мы открываем как несжатый
+        with index_lock(logs_dir):
+            timeline.extend(_query_day(day_dir, user_id, files, since))
+    # Строка начинается с "%Y-%m-%d %H:%M:%S" — сортировка по ней хронологическая
+    timeline.sort(key=lambda entry: (entry["line"][:19], entry["file"]))
+    return timeline[-limit:]
+
+
+def _query_day(day_dir: Path, user_id: int, files: List[str], since: str) -> List[Dict[str, str]]:
+    timeline = []
+    conn = _open_index(day_dir)
+    try:
+        placeholders = ",".join("?" * len(files))
+        file_rows = conn.execute(
+            f"SELECT file_id, name, compressed FROM files WHERE name IN ({placeholders})", files
+        ).fetchall()
+        for file_id, name, compressed in file_rows:
+            # Смещения из индекса старого формата без даты строки фильтруем по имени папки
+            offsets = conn.execute(
+                "SELECT offset, COALESCE(day, ?) FROM offsets "
+                "WHERE user_id = ? AND file_id = ? AND COALESCE(day, ?) >= ? ORDER BY offset",
+                (day_dir.name, user_id, file_id, day_dir.name, since)
+            ).fetchall()
+            if not offsets:
+                continue
+            reader = _LogReader(conn, day_dir, file_id, name, bool(compressed))
+            try:
+                for offset, day in offsets:
+                    timeline.append({"day": day, "file": name, "line": reader.read_line(offset)})
+            finally:
+                reader.close()
+    finally:
+        conn.close()
+    return timeline
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-user offset index over daily logs")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("build", help="проиндексировать все дни")
+    sub.add_parser("compress", help="сжать завершённые дни")
+    query = sub.add_parser("query", help="хронология пользователя")
+    query.add_argument("user_id", type=int)
+    query.add_argument("--days", type=int, default=7)
+    query.add_argument("--limit", type=int, default=1000)
+    query.add_argument("--json", action="store_true", help="вывод в JSON")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        print(f"Indexed {sum(index_day(d) for d in day_dirs())} new entries")
+    elif args.command == "compress":
+        for path in compress_finished_days():
+            print(f"Compressed {path}")
+    else:
+        # Перед запросом дочитываем свежие строки, чтобы не отставать от логов
+        for day_dir in day_dirs():
+            index_day(day_dir)
+        timeline = query_user(args.user_id, days=args.days, limit=args.limit)
+        if args.json:
+            print(json.dumps(timeline, indent=2, ensure_ascii=False))
+        else:
+            for entry in timeline:
+                print(f"[{entry['file']}] {entry['line']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+import asyncio
+import itertools
+import sys
+import tracemalloc
+from collections import OrderedDict
+from collections.abc import Mapping
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Set
+
+from logger_config import log_system_event
+
+MAX_SNAPSHOTS = 5  # старые снимки удаляются, чтобы профилировщик сам не раздувал память
+SIZE_SAMPLE = 200  # сколько элементов структуры измерять для оценки её размера
+MAX_FRAMES = 65535  # предел глубины трассировки tracemalloc
+
+
+class MemoryProfiler:
+    """Управление tracemalloc для админ-панели: запуск, именованные снимки, диффы.
+
+    Пока трассировка выключена, профилировщик ничего не делает и не стоит ничего.
+    """
+
+    def __init__(self):
+        self.snapshots: "OrderedDict[str, tracemalloc.Snapshot]" = OrderedDict()
+        self.started_at: Optional[datetime] = None
+
+    @property
+    def is_tracing(self) -> bool:
+        return tracemalloc.is_tracing()
+
+    def start(self, frames: int = 1):
+        if not 1 <= frames <= MAX_FRAMES:
+            raise ValueError(f"frames must be in range [1; {MAX_FRAMES}]")
+        if self.is_tracing:
+            return
+        tracemalloc.start(frames)
+        self.started_at = datetime.now()
+        log_system_event("tracemalloc started", f"frames={frames}")
+
+    def stop(self):
+        if not self.is_tracing:
+            return
+        tracemalloc.stop()
+        self.started_at = None
+        log_system_event("tracemalloc stopped")
+
+    def take_snapshot(self, name: str) -> Dict[str, Any]:
+        if not self.is_tracing:
+            raise RuntimeError("tracemalloc is not running")
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        ))
+        self.snapshots.pop(name, None)
+        self.snapshots[name] = snapshot
+        while len(self.snapshots) > MAX_SNAPSHOTS:
+            self.snapshots.popitem(last=False)
+        total = sum(stat.size for stat in snapshot.statistics("filename"))
+        return {"name": name, "total_kb": round(total / 1024, 1)}
+
+    def diff(self, base: str, target: str, top: int = 20, group_by: str = "lineno") -> List[Dict[str, Any]]:
+        """Топ-N изменений аллокаций между двумя снимками, по файлу или строке"""
+        if group_by not in ("lineno", "filename"):
+            raise ValueError("group_by must be 'lineno' or 'filename'")
+        if top < 1:
+            raise ValueError("top must be a positive integer")
+        if base not in self.snapshots or target not in self.snapshots:
+            raise KeyError("Unknown snapshot name")
+        stats = self.snapshots[target].compare_to(self.snapshots[base], group_by)
+        return [
+            {
+                "location": str(stat.traceback[0]),
+                "size_kb": round(stat.size / 1024, 1),
+                "size_diff_kb": round(stat.size_diff / 1024, 1),
+                "count": stat.count,
+                "count_diff": stat.count_diff,
+            }
+            for stat in stats[:top]
+        ]
+
+    def get_status(self) -> Dict[str, Any]:
+        status = {
+            "tracing": self.is_tracing,
+            "started_at": self.started_at.isoformat(timespec="seconds") if self.started_at else None,
+            "snapshots": list(self.snapshots),
+        }
+        if self.is_tracing:
+            current, peak = tracemalloc.get_traced_memory()
+            status["traced_kb"] = round(current / 1024, 1)
+            status["peak_kb"] = round(peak / 1024, 1)
+            status["overhead_kb"] = round(tracemalloc.get_tracemalloc_memory() / 1024, 1)
+        return status
+
+
+def _deep_size(obj: Any, seen: Set[int], depth: int = 3) -> int:
+    """Приблизительный размер объекта вместе с вложенными контейнерами.
+
+    Объекты, уже учтённые в seen (по id()), не считаются повторно: одно кольцо
+    message_maps лежит под ключами обоих собеседников. Объекты со __slots__
+    должны сами учитывать свои буферы в __sizeof__ (см. MessageIdRing).
+    """
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if depth <= 0:
+        return size
+    if isinstance(obj, Mapping):
+        size += sum(_deep_size(k, seen, depth - 1) + _deep_size(v, seen, depth - 1) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(_deep_size(item, seen, depth - 1) for item in obj)
+    return size
+
+
+def estimate_size(obj: Any) -> int:
+    """Оценивает размер структуры по выборке из первых SIZE_SAMPLE элементов"""
+    size = sys.getsizeof(obj)
+    count = len(obj)
+    if not count:
+        return size
+    seen = {id(obj)}
+    if isinstance(obj, Mapping):
+        # У UserCache читаем через peek, чтобы отчёт не портил LRU и статистику
+        getter = getattr(obj, "peek", obj.get)
+        sample = [
+            _deep_size(k, seen) + _deep_size(getter(k), seen)
+            for k in itertools.islice(iter(obj), SIZE_SAMPLE)
+        ]
+    else:
+        sample = [_deep_size(item, seen) for item in itertools.islice(iter(obj), SIZE_SAMPLE)]
+    return size + int(sum(sample) / len(sample) * count)
+
+
+def structure_report(structures: Dict[str, Any]) -> Dict[str, Dict[str, Any]]:
+    """Число элементов и оценка памяти для каждой структуры состояния бота"""
+    report = {}
+    for name, obj in structures.items():
+        report[name] = {"items": len(obj), "approx_kb": round(estimate_size(obj) / 1024, 1)}
+    report["asyncio_tasks"] = {"items": len(asyncio.all_tasks()), "approx_kb": None}
+    return report
@@ -0,0 +1,49 @@
+import sys
+from array import array
+from typing import Optional
+
+
+class MessageIdRing:
+    """Соответствие message_id между двумя участниками чата фиксированного размера.
+
+    Хранит последние capacity пар (id у первого участника, id у второго)
+    в двух массивах int64 — около 16 байт на сообщение вместо словаря
+    на каждое сообщение. Самые старые пары перезаписываются по кругу.
+    """
+
+    __slots__ = ("first_user", "capacity", "_first_ids", "_second_ids", "_head")
+
+    def __init__(self, first_user: int, capacity: int):
+        self.first_user = first_user
+        self.capacity = capacity
+        # 0 — пустая ячейка: message_id в Telegram начинаются с 1
+        self._first_ids = array("q", bytes(8 * capacity))
+        self._second_ids = array("q", bytes(8 * capacity))
+        self._head = 0
+
+    def add(self, sender_id: int, sender_message_id: int, copy_message_id: int):
+        """Запоминает, что сообщение отправителя доставлено собеседнику как copy_message_id"""
+        if sender_id == self.first_user:
+            self._first_ids[self._head] = sender_message_id
+            self._second_ids[self._head] = copy_message_id
+        else:
+            self._first_ids[self._head] = copy_message_id
+            self._second_ids[self._head] = sender_message_id
+        self._head = (self._head + 1) % self.capacity
+
+    def __sizeof__(self) -> int:
+        # У __slots__-объекта getsizeof не видит массивы — добавляем их сами
+        return object.__sizeof__(self) + sys.getsizeof(self._first_ids) + sys.getsizeof(self._second_ids)
+
+    def lookup(self, user_id: int, message_id: int) -> Optional[int]:
+        """По id сообщения в чате user_id возвращает id того же сообщения у собеседника"""
+        if message_id <= 0:
+            return None
+        own, other = (
+            (self._first_ids, self._second_ids) if user_id == self.first_user
+            else (self._second_ids, self._first_ids)
+        )
+        try:
+            return other[own.index(message_id)]
+        except ValueError:
+            return None
@@ -0,0 +1,215 @@
+"""Воспроизведение записанного трафика против бота с заглушкой вместо Telegram API.
+
+Запись делается ботом при заданном TRAFFIC_CAPTURE_PATH (см. traffic_capture.py).
+
+    python replay.py capture.jsonl.gz --speed 1     # в реальном темпе
+    python replay.py capture.jsonl.gz --speed 10    # в 10 раз быстрее
+    python replay.py capture.jsonl.gz --speed max   # без пауз, последовательно
+
+Часы бота (current_time) идут по времени записи, а не по настенным:
+при ускорении анти-спам и сроки блокировок видят те же интервалы между
+сообщениями, что и в жизни.
+
+Отчёт: перцентили времени обработки апдейта, число исходящих вызовов API
+по методам, сколько сообщений отсёк анти-спам, и контрольная сумма итогового
+состояния бота. Два билда на одной записи с --speed max должны давать
+одинаковую контрольную сумму.
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import Counter
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+REPO_DIR = Path(__file__).resolve().parent
+sys.path.insert(0, str(REPO_DIR))
+
+from aiogram.client.session.base import BaseSession
+from aiogram.methods import TelegramMethod
+from aiogram.types import Chat, Message, Update
+
+from traffic_capture import read_capture
+
+FAKE_TOKEN = "123456789:REPLAY-replay-replay-replay-replay"
+
+
+class ReplaySession(BaseSession):
+    """Сессия-заглушка: ничего не отправляет, считает вызовы и отвечает правдоподобно"""
+
+    def __init__(self, api_latency: float = 0.0):
+        super().__init__()
+        self.api_latency = api_latency
+        self.calls: Counter = Counter()
+        self._message_id = 0
+
+    async def make_request(self, bot, method: TelegramMethod, timeout: Optional[int] = None) -> Any:
+        self.calls[type(method).__name__] += 1
+        if self.api_latency:
+            await asyncio.sleep(self.api_latency)
+        if method.__returning__ is Message:
+            self._message_id += 1
+            chat_id = getattr(method, "chat_id", 0)
+            return Message(
+                message_id=self._message_id,
+                date=datetime.now(),
+                chat=Chat(id=chat_id if isinstance(chat_id, int) else 0, type="private")
+            )
+        return True
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        raise NotImplementedError("Replay session does not download files")
+        yield b""  # делает метод асинхронным генератором, как у BaseSession
+
+    async def close(self):
+        pass
+
+
+def load_bot_module():
+    """Импортирует bot.py в изолированном рабочем каталоге, чтобы логи и store не смешивались с боевыми"""
+    os.environ["BOT_TOKEN"] = FAKE_TOKEN
+    os.environ["USER_STORE_PATH"] = ":memory:"
+    os.environ.pop("TRAFFIC_CAPTURE_PATH", None)
+    os.chdir(tempfile.mkdtemp(prefix="replay-"))
+    import bot as bot_module
+    # Консольный вывод хендлеров только мешает отчёту
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        if type(handler) is logging.StreamHandler:
+            root.removeHandler(handler)
+    return bot_module
+
+
+def state_checksum(bot_module) -> str:
+    """Контрольная сумма состояния, не зависящая от времени прогона"""
+    state = {
+        "waiting_queue": list(bot_module.waiting_queue),
+        "active_chats": sorted(bot_module.active_chats.items()),
+        # resident_items не трогает LRU/TTL и статистику кэшей
+        "user_states": sorted((uid, s.value) for uid, s in bot_module.user_states.resident_items()),
+        "user_profiles": sorted(bot_module.user_profiles.resident_items()),
+        "anonymous_names": sorted(bot_module.anonymous_names.resident_items()),
+        "user_stats": sorted(bot_module.user_stats.resident_items()),
+        # Сроки блокировок зависят от времени прогона, учитываем только пары
+        "blacklist": sorted((uid, sorted(blocked)) for uid, blocked in bot_module.blacklist.items()),
+    }
+    raw = json.dumps(state, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+def percentile(sorted_values: List[float], pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+async def replay(path: str, speed: Optional[float], api_latency: float, seed: int) -> Dict[str, Any]:
+    bot_module = load_bot_module()
+    session = ReplaySession(api_latency=api_latency)
+    bot_module.bot.session = session
+    bot, dp = bot_module.bot, bot_module.dp
+    random.seed(seed)
+
+    # Время записи последнего поданного апдейта — часы бота во время прогона
+    clock = {"now": datetime.now()}
+    bot_module.current_time = lambda: clock["now"]
+    spam_limited = 0
+    check_spam = bot_module.check_spam
+
+    def counting_check_spam(user_id: int) -> bool:
+        nonlocal spam_limited
+        limited = check_spam(user_id)
+        spam_limited += limited
+        return limited
+
+    bot_module.check_spam = counting_check_spam
+
+    latencies: List[float] = []
+    errors = 0
+
+    async def process(raw: Dict[str, Any]):
+        nonlocal errors
+        update = Update.model_validate(raw, context={"bot": bot})
+        started = time.perf_counter()
+        try:
+            await dp.feed_update(bot, update)
+        except Exception:
+            errors += 1
+        latencies.append(time.perf_counter() - started)
+
+    tasks = []
+    first_ts = None
+    wall_start = time.perf_counter()
+    for ts, raw in read_capture(path):
+        clock["now"] = datetime.fromtimestamp(ts)
+        if speed is None:
+            # Максимальная скорость: строго по очереди, чтобы результат был детерминированным
+            await process(raw)
+            continue
+        if first_ts is None:
+            first_ts = ts
+        delay = (ts - first_ts) / speed - (time.perf_counter() - wall_start)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        # Как при polling: каждый апдейт обрабатывается отдельной задачей
+        tasks.append(asyncio.create_task(process(raw)))
+    if tasks:
+        await asyncio.gather(*tasks)
+    wall_time = time.perf_counter() - wall_start
+
+    # Таймеры автозавершения чатов не должны пережить прогон
+    for task in bot_module.chat_timers.values():
+        task.cancel()
+
+    latencies.sort()
+    return {
+        "updates": len(latencies),
+        "errors": errors,
+        "wall_time_s": round(wall_time, 3),
+        "updates_per_s": round(len(latencies) / wall_time, 1) if wall_time else 0.0,
+        "latency_ms": {
+            "p50": round(percentile(latencies, 50) * 1000, 3),
+            "p90": round(percentile(latencies, 90) * 1000, 3),
+            "p99": round(percentile(latencies, 99) * 1000, 3),
+            "max": round(latencies[-1] * 1000, 3) if latencies else 0.0,
+        },
+        "api_calls": dict(session.calls.most_common()),
+        "api_calls_total": sum(session.calls.values()),
+        "spam_limited": spam_limited,
+        "state_checksum": state_checksum(bot_module),
+    }
+
+
+def parse_speed(value: str) -> Optional[float]:
+    if value == "max":
+        return None
+    speed = float(value)
+    if speed <= 0:
+        raise argparse.ArgumentTypeError("speed must be positive or 'max'")
+    return speed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay captured updates against a stubbed Bot")
+    parser.add_argument("capture", help="файл записи (gzip JSON Lines)")
+    parser.add_argument("--speed", type=parse_speed, default=None, help="1, 10, ... или max (по умолчанию max)")
+    parser.add_argument("--api-latency", type=float, default=0.0, help="искусственная задержка ответа API, мс")
+    parser.add_argument("--seed", type=int, default=0, help="seed для генерации анонимных имён")
+    args = parser.parse_args()
+
+    capture = str(Path(args.capture).resolve())
+    report = asyncio.run(replay(capture, args.speed, args.api_latency / 1000, args.seed))
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+import gzip
+import hashlib
+import json
+import os
+import time
+import zlib
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, Iterator, Tuple
+
+from aiogram import BaseMiddleware
+from aiogram.types import Update
+
+from logger_config import log_system_event, log_error
+
+# Типы объекта Chat: по ним и по is_bot у User объект узнаётся в любом поле апдейта
+CHAT_TYPES = {"private", "group", "supergroup", "channel"}
+# Поля, которые всегда содержат id пользователя или чата
+ID_FIELDS = {"user_id", "chat_id", "user_chat_id"}
+# Поля с личными данными, которые не попадают в запись
+PERSONAL_FIELDS = {
+    "first_name": "User", "last_name": None, "username": None, "phone_number": "+70000000000",
+    "sender_user_name": None, "forward_sender_name": None,
+}
+ANON_ID_BITS = 40
+# Сбрасываем сжатые данные на диск, чтобы после падения терялось не больше этого
+FLUSH_EVERY_RECORDS = 100
+FLUSH_EVERY_SECONDS = 5.0
+
+
+class IdRemapper:
+    """Заменяет реальные user_id/chat_id анонимными через хэш с секретной солью.
+
+    Соль генерируется при старте и нигде не сохраняется, поэтому по записи
+    нельзя восстановить настоящие идентификаторы. С новой солью тот же
+    пользователь получает другой id, поэтому каждый запуск пишет свой файл
+    (см. run_capture_path).
+    """
+
+    def __init__(self):
+        self._salt = os.urandom(16)
+        self._mapping: Dict[int, int] = {}
+
+    def remap_id(self, real_id: int) -> int:
+        if real_id not in self._mapping:
+            digest = hashlib.blake2b(str(abs(real_id)).encode(), key=self._salt, digest_size=8).digest()
+            anon_id = int.from_bytes(digest, "big") >> (64 - ANON_ID_BITS) or 1
+            # Сохраняем знак: отрицательные id у групп и каналов
+            self._mapping[real_id] = -anon_id if real_id < 0 else anon_id
+        return self._mapping[real_id]
+
+    def scrub(self, data: Any) -> Any:
+        """Рекурсивно обходит сериализованный апдейт, заменяя id и личные поля.
+
+        id заменяется в каждом объекте вида User или Chat, где бы он ни лежал
+        (from, forward_origin.sender_user, reply_to_message.chat и т.д.),
+        а не по списку известных полей: новые поля Bot API не дают утечек.
+        """
+        if isinstance(data, dict):
+            is_user_or_chat = "is_bot" in data or data.get("type") in CHAT_TYPES
+            result = {}
+            for key, value in data.items():
+                if key in PERSONAL_FIELDS:
+                    if PERSONAL_FIELDS[key] is not None:
+                        result[key] = PERSONAL_FIELDS[key]
+                    continue
+                if isinstance(value, int) and not isinstance(value, bool) and (
+                    (key == "id" and is_user_or_chat) or key in ID_FIELDS
+                ):
+                    result[key] = self.remap_id(value)
+                else:
+                    result[key] = self.scrub(value)
+            return result
+        if isinstance(data, list):
+            return [self.scrub(item) for item in data]
+        return data
+
+
+def run_capture_path(path: str) -> str:
+    """Файл записи этого запуска: capture.jsonl.gz -> capture-20240101-120000.jsonl.gz"""
+    target = Path(path)
+    stem, dot, suffixes = target.name.partition(".")
+    return str(target.with_name(f"{stem}-{datetime.now():%Y%m%d-%H%M%S}{dot}{suffixes}"))
+
+
+class TrafficRecorder(BaseMiddleware):
+    """Outer-middleware, записывающий входящие апдейты в gzip-файл JSON Lines.
+
+    Каждая строка: {"t": unix-время получения, "u": апдейт с анонимными id}.
+    Каждый запуск пишет в новый файл (run_capture_path): анонимные id
+    согласованы только в пределах одного запуска.
+    Данные сбрасываются на диск каждые FLUSH_EVERY_RECORDS записей или
+    FLUSH_EVERY_SECONDS секунд, так что после падения процесса файл читается
+    до последнего сброса (см. read_capture).
+    """
+
+    def __init__(self, path: str):
+        self.path = run_capture_path(path)
+        self.remapper = IdRemapper()
+        self.recorded = 0
+        self._unflushed = 0
+        self._last_flush = time.monotonic()
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        self._file = gzip.open(self.path, "wt", encoding="utf-8", compresslevel=6)
+        log_system_event("Traffic capture started", self.path)
+
+    async def __call__(
+        self,
+        handler: Callable[[Update, Dict[str, Any]], Awaitable[Any]],
+        event: Update,
+        data: Dict[str, Any]
+    ) -> Any:
+        try:
+            raw = event.model_dump(mode="json", exclude_none=True)
+            record = {
+                "t": round(time.time(), 3),
+                "u": self.remapper.scrub(raw)
+            }
+            self._file.write(json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n")
+            self.recorded += 1
+            self._unflushed += 1
+            if (self._unflushed >= FLUSH_EVERY_RECORDS
+                    or time.monotonic() - self._last_flush >= FLUSH_EVERY_SECONDS):
+                self._file.flush()
+                self._unflushed = 0
+                self._last_flush = time.monotonic()
+        except Exception as e:
+            # Запись трафика никогда не должна ломать обработку апдейта
+            log_error("Failed to capture update", str(e))
+        return await handler(event, data)
+
+    def close(self):
+        self._file.close()
+        log_system_event("Traffic capture stopped", f"{self.recorded} updates written to {self.path}")
+
+
+def read_capture(path: str) -> Iterator[Tuple[float, Dict[str, Any]]]:
+    """Читает файл записи, возвращая пары (unix-время, апдейт).
+
+    Если бот упал во время записи, у последней gzip-части нет концевика:
+    читаем до последней целой строки и останавливаемся.
+    """
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        while True:
+            try:
+                line = f.readline()
+            except (EOFError, zlib.error, gzip.BadGzipFile):
+                log_system_event("Capture file is truncated", f"{path}: stopped at last complete record")
+                return
+            if not line:
+                return
+            if not line.endswith("\n"):
+                # Оборванная последняя строка
+                return
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            yield record["t"], record["u"]
@@ -0,0 +1,308 @@
+import heapq
+import json
+import sqlite3
+import sys
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from logger_config import log_system_event
+
+
+# --- Хранилища для вытесненных данных ---
+class UserStore(ABC):
+    """Базовый интерфейс хранилища для долговременных полей пользователя"""
+
+    @abstractmethod
+    def get(self, namespace: str, user_id: int) -> Optional[Any]:
+        ...
+
+    @abstractmethod
+    def put(self, namespace: str, user_id: int, value: Any):
+        ...
+
+    @abstractmethod
+    def put_many(self, namespace: str, items: List[Tuple[int, Any]]):
+        """Сохраняет пачку записей одной транзакцией"""
+
+    @abstractmethod
+    def delete(self, namespace: str, user_id: int):
+        ...
+
+    @abstractmethod
+    def count(self, namespace: str) -> int:
+        ...
+
+    @abstractmethod
+    def ids_after(self, namespace: str, after: int, limit: int) -> List[int]:
+        """Возвращает до limit user_id больше after по возрастанию"""
+
+    def close(self):
+        pass
+
+
+class SqliteUserStore(UserStore):
+    """Хранилище на SQLite: одна таблица, значения в JSON"""
+
+    def __init__(self, path: str):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(path)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS user_data ("
+            "namespace TEXT NOT NULL, user_id INTEGER NOT NULL, value TEXT NOT NULL, "
+            "PRIMARY KEY (namespace, user_id))"
+        )
+        self._conn.commit()
+
+    def get(self, namespace: str, user_id: int) -> Optional[Any]:
+        row = self._conn.execute(
+            "SELECT value FROM user_data WHERE namespace = ? AND user_id = ?",
+            (namespace, user_id)
+        ).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def put(self, namespace: str, user_id: int, value: Any):
+        self.put_many(namespace, [(user_id, value)])
+
+    def put_many(self, namespace: str, items: List[Tuple[int, Any]]):
+        if not items:
+            return
+        with self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO user_data (namespace, user_id, value) VALUES (?, ?, ?)",
+                [(namespace, user_id, json.dumps(value, ensure_ascii=False)) for user_id, value in items]
+            )
+
+    def delete(self, namespace: str, user_id: int):
+        self._conn.execute(
+            "DELETE FROM user_data WHERE namespace = ? AND user_id = ?",
+            (namespace, user_id)
+        )
+        self._conn.commit()
+
+    def count(self, namespace: str) -> int:
+        row = self._conn.execute(
+            "SELECT COUNT(*) FROM user_data WHERE namespace = ?", (namespace,)
+        ).fetchone()
+        return row[0]
+
+    def ids_after(self, namespace: str, after: int, limit: int) -> List[int]:
+        rows = self._conn.execute(
+            "SELECT user_id FROM user_data WHERE namespace = ? AND user_id > ? "
+            "ORDER BY user_id LIMIT ?",
+            (namespace, after, limit)
+        ).fetchall()
+        return [row[0] for row in rows]
+
+    def close(self):
+        self._conn.close()
+
+
+# --- Ограниченный кэш пользователей ---
+SHRINK_FRACTION = 0.01  # доля max_size, освобождаемая за одно вытеснение
+class UserCache(MutableMapping):
+    """Словарь user_id -> значение с LRU/TTL-вытеснением неактивных пользователей.
+
+    Без store вытесненная запись просто удаляется (эфемерное состояние).
+    Со store она сохраняется туда и подгружается обратно при следующем обращении.
+    Пользователи, для которых pinned(user_id) истинно, не вытесняются.
+    Итерация и len() видят только записи, находящиеся в памяти.
+    Диагностика должна читать через peek/lookup/resident_items: обычное
+    чтение продлевает жизнь записи и учитывается в hit rate.
+    """
+
+    def __init__(self, name: str, max_size: int, ttl: Optional[float] = None,
+                 store: Optional[UserStore] = None,
+                 pinned: Optional[Callable[[int], bool]] = None):
+        self.name = name
+        self.max_size = max_size
+        self.ttl = ttl
+        self.store = store
+        self.pinned = pinned
+        self._data: "OrderedDict[int, Any]" = OrderedDict()
+        self._last_seen: Dict[int, float] = {}
+        self.hits = 0
+        self.misses = 0
+        self.loads = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.spills = 0
+
+    # --- Внутренние помощники ---
+    def _touch(self, user_id: int):
+        self._data.move_to_end(user_id)
+        self._last_seen[user_id] = time.monotonic()
+
+    def _is_expired(self, user_id: int, now: float) -> bool:
+        if self.ttl is None:
+            return False
+        return now - self._last_seen.get(user_id, now) > self.ttl
+
+    def _is_pinned(self, user_id: int) -> bool:
+        return self.pinned is not None and self.pinned(user_id)
+
+    def _evict(self, user_id: int) -> Any:
+        """Убирает запись из памяти; в store её сохраняет вызывающий через _spill"""
+        self._last_seen.pop(user_id, None)
+        return self._data.pop(user_id)
+
+    def _spill(self, items: List[Tuple[int, Any]]):
+        """Сохраняет вытесненные записи в store одной транзакцией"""
+        if self.store is None or not items:
+            return
+        self.store.put_many(self.name, items)
+        self.spills += len(items)
+
+    def _load(self, user_id: int) -> bool:
+        """Подгружает запись из store в память. Возвращает True, если нашлась"""
+        if self.store is None:
+            return False
+        value = self.store.get(self.name, user_id)
+        if value is None:
+            return False
+        self._data[user_id] = value
+        self._touch(user_id)
+        self.loads += 1
+        self._shrink()
+        return True
+
+    def _shrink(self):
+        """Вытесняет самые давние записи, когда кэш превысил max_size.
+
+        Освобождает сразу SHRINK_FRACTION места, чтобы запись в store шла
+        пачками, а не транзакцией на каждого нового пользователя.
+        """
+        if len(self._data) <= self.max_size:
+            return
+        target = max(0, self.max_size - int(self.max_size * SHRINK_FRACTION))
+        evicted = []
+        skipped = 0
+        while len(self._data) > target and skipped < len(self._data):
+            user_id = next(iter(self._data))
+            if self._is_pinned(user_id):
+                # Закреплённых переносим в конец, чтобы не зациклиться на них
+                self._data.move_to_end(user_id)
+                skipped += 1
+                continue
+            evicted.append((user_id, self._evict(user_id)))
+        self.evictions += len(evicted)
+        self._spill(evicted)
+
+    # --- Интерфейс словаря ---
+    def __getitem__(self, user_id: int) -> Any:
+        if user_id in self._data:
+            # Истёкшее эфемерное состояние считается отсутствующим
+            if (self.store is None and self._is_expired(user_id, time.monotonic())
+                    and not self._is_pinned(user_id)):
+                self._evict(user_id)
+                self.expirations += 1
+            else:
+                self.hits += 1
+                self._touch(user_id)
+                return self._data[user_id]
+        self.misses += 1
+        if self._load(user_id):
+            return self._data[user_id]
+        raise KeyError(user_id)
+
+    def __setitem__(self, user_id: int, value: Any):
+        self._data[user_id] = value
+        self._touch(user_id)
+        self._shrink()
+
+    def __delitem__(self, user_id: int):
+        found = self._data.pop(user_id, None) is not None
+        self._last_seen.pop(user_id, None)
+        if self.store is not None and self.store.get(self.name, user_id) is not None:
+            self.store.delete(self.name, user_id)
+            found = True
+        if not found:
+            raise KeyError(user_id)
+
+    def __contains__(self, user_id: object) -> bool:
+        try:
+            self[user_id]
+        except KeyError:
+            return False
+        return True
+
+    def peek(self, user_id: int, default: Any = None) -> Any:
+        """Возвращает значение из памяти без учёта в статистике и без подгрузки"""
+        return self._data.get(user_id, default)
+
+    def resident_items(self) -> List[Tuple[int, Any]]:
+        """Копия записей в памяти для админ-панели и диагностики: без LRU, TTL и статистики"""
+        return list(self._data.items())
+
+    def lookup(self, user_id: int, default: Any = None) -> Any:
+        """Возвращает значение из памяти или store, не подгружая его в кэш"""
+        if user_id in self._data:
+            return self._data[user_id]
+        if self.store is not None:
+            value = self.store.get(self.name, user_id)
+            if value is not None:
+                return value
+        return default
+
+    def ids_after(self, after: int, limit: int) -> List[int]:
+        """Все известные user_id (в памяти и в store) больше after, по возрастанию"""
+        resident = heapq.nsmallest(limit, (uid for uid in self._data if uid > after))
+        stored = self.store.ids_after(self.name, after, limit) if self.store is not None else []
+        return sorted(set(resident).union(stored))[:limit]
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(list(self._data))
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __sizeof__(self) -> int:
+        return object.__sizeof__(self) + sys.getsizeof(self._data) + sys.getsizeof(self._last_seen)
+
+    # --- Обслуживание ---
+    def sweep(self) -> int:
+        """Вытесняет записи, не использовавшиеся дольше ttl. Возвращает их количество"""
+        if self.ttl is None:
+            return 0
+        now = time.monotonic()
+        expired = [
+            uid for uid in self._data
+            if self._is_expired(uid, now) and not self._is_pinned(uid)
+        ]
+        self._spill([(uid, self._evict(uid)) for uid in expired])
+        self.expirations += len(expired)
+        return len(expired)
+
+    def flush(self):
+        """Сохраняет все записи из памяти в store (при остановке бота)"""
+        if self.store is not None:
+            self.store.put_many(self.name, list(self._data.items()))
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Статистика попаданий и вытеснений для админ-панели"""
+        lookups = self.hits + self.misses
+        return {
+            "resident": len(self._data),
+            "max_size": self.max_size,
+            "ttl": self.ttl,
+            "stored": self.store.count(self.name) if self.store is not None else 0,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "loads": self.loads,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "spills": self.spills,
+        }
+
+
+def sweep_caches(caches) -> int:
+    """Прогоняет sweep() по всем кэшам и логирует результат"""
+    total = sum(cache.sweep() for cache in caches)
+    if total:
+        log_system_event("User cache sweep", f"Evicted {total} inactive entries")
+    return total